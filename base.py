@@ -16,6 +16,7 @@ from wrapid.json_representation import JsonRepresentation
 
 from . import configuration
 from . import mimeutils
+from .cache import navigation, documents
 from .html_representation import *
 from .medline_representation import *
 from .atom_representation import *
@@ -85,7 +86,8 @@ class MethodMixin(LoginMixin):
     def set_current_publication(self, request):
         "Set the publication to operate on."
         try:
-            self.publication = dict(self.db[request.variables['iui']])
+            self.publication = dict(documents.get(self.db,
+                                                  request.variables['iui']))
         except couchdb.http.ResourceNotFound:
             raise HTTP_NOT_FOUND
         if self.publication['entitytype'] != 'publication':
@@ -138,23 +140,19 @@ class MethodMixin(LoginMixin):
                               href=get_url('pubmed', 'import')))
             links.append(dict(title='Administration:PubMed fetched',
                               href=get_url('pubmed', 'fetched')))
-        years = self.get_years()
+            links.append(dict(title='Administration: Duplicates',
+                              href=get_url('duplicates')))
+            links.append(dict(title='Administration: Cache statistics',
+                              href=get_url('stats')))
+        data = navigation.get(self.db)
+        years = data['years']
         for year in reversed(sorted(years.keys())):
             links.append(dict(title="Year (all PIs): %s" % year,
                               href=get_url('year', str(year)),
                               count=years[year]))
-        try:
-            doc = self.db['pilist']
-        except couchdb.http.ResourceNotFound:
-            pass
-        else:
-            pis = doc['pis']
-            pis.sort(lambda i, j: cmp(i['name'].lower(), j['name'].lower()))
-            for pi in pis:
-                name = pi['name']
-                key = to_ascii(name).lower().replace(' ', '_')
-                links.append(dict(title="Principal Investigator: %s" % name,
-                                  href=get_url('author', key)))
+        for name, key in data['pis']:
+            links.append(dict(title="Principal Investigator: %s" % name,
+                              href=get_url('author', key)))
         ## for item in self.db.view('publication/tags', group=True):
         ##     links.append(dict(title="Tags: %s" % item.key,
         ##                       href=get_url('tag', item.key)))
@@ -177,14 +175,15 @@ class MethodMixin(LoginMixin):
         """Get a dictionary where the keys are the publication years
         and the values are the total number of publications for the year.
         """
-        view = self.db.view('publication/years', group=True)
-        return dict([(int(r.key), r.value) for r in view])
+        return dict(navigation.get(self.db)['years'])
 
     def get_docs(self, indexname, key, last=None, distinct=True, **kwargs):
         """Get the list of documents using the named index
-        and the given key or interval.
+        and the given key or interval. The documents are added
+        to the document cache.
         """
         kwargs['include_docs'] = True
+        token = documents.counter
         view = self.db.view(indexname, **kwargs)
         if key is None:
             iterator = view
@@ -196,6 +195,7 @@ class MethodMixin(LoginMixin):
         lookup = set()
         for item in iterator:
             if distinct and item.id in lookup: continue
+            documents.put(item.doc, token=token)
             result.append(item.doc)
             lookup.add(item.id)
         return result
@@ -203,7 +203,7 @@ class MethodMixin(LoginMixin):
     def normalize_publication(self, publication, get_url):
         """Normalize the contents of the publication:
         Change key '_id' to 'iui' and '_rev' to 'rev'.
-        Remove the '_attachments' entry.
+        Remove the '_attachments' and the internal 'lsh' entries.
         Add the 'href' entry.
         Add the 'alt_href' entry, if slug defined.
         Add 'href' to each author."""
@@ -214,6 +214,7 @@ class MethodMixin(LoginMixin):
         if slug:
             publication['alt_href'] = get_url(slug)
         publication.pop('_attachments', None)
+        publication.pop('lsh', None)
         for author in publication['authors']:
             name = get_author_name(author)
             name = to_ascii(name.replace(' ', '_')).lower()
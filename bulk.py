@@ -0,0 +1,51 @@
+""" PubRefDb: Publication database web application.
+
+Reading documents and view rows from the database in bulk.
+"""
+
+from pubrefdb import configuration
+
+
+def iterate_view(db, name, chunk_size=None, **options):
+    """Iterate over the rows of the named view (or '_all_docs'),
+    fetching them in chunks using startkey cursors.
+    Memory use is bounded by the chunk size.
+    Rows of grouped reduce views have no id; the key alone is the cursor.
+    """
+    chunk_size = chunk_size or configuration.BULK_CHUNK_SIZE
+    options['limit'] = chunk_size + 1
+    while True:
+        rows = list(db.view(name, **options))
+        for row in rows[:chunk_size]:
+            yield row
+        if len(rows) <= chunk_size: break
+        options['startkey'] = rows[-1].key
+        if rows[-1].id is not None:
+            options['startkey_docid'] = rows[-1].id
+
+
+def get_revisions(db, ids):
+    """Get the current revisions of the documents with the given ids,
+    using one '_all_docs' request. Return a dictionary keyed by id;
+    documents not existing or deleted are not included.
+    """
+    result = dict()
+    for row in db.view('_all_docs', keys=list(ids)):
+        if row.value and not row.value.get('deleted'):
+            result[row.key] = row.value['rev']
+    return result
+
+
+def fetch_docs(db, ids, chunk_size=None):
+    """Get the documents with the given ids, in that order, using one
+    '_all_docs' request with POSTed keys per chunk of ids.
+    Documents not existing or deleted are skipped.
+    """
+    chunk_size = chunk_size or configuration.BULK_CHUNK_SIZE
+    ids = list(ids)
+    for start in xrange(0, len(ids), chunk_size):
+        for row in db.view('_all_docs',
+                           keys=ids[start:start+chunk_size],
+                           include_docs=True):
+            if row.doc is not None:
+                yield row.doc
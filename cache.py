@@ -0,0 +1,350 @@
+""" PubRefDb: Publication database web application.
+
+In-process caches shared by all requests in a worker process.
+"""
+
+import logging
+import threading
+import time
+
+import couchdb
+from couchdb import json
+
+from wrapid.utils import to_ascii
+
+from . import configuration
+from .bulk import fetch_docs, get_revisions
+
+
+_seq_lock = threading.Lock()
+_seq = dict(value=None, checked=0.0)
+
+def get_update_seq(db):
+    """Get the update sequence of the database. The value is memoized,
+    and the database asked at most every CACHE_CHECK_INTERVAL seconds.
+    """
+    with _seq_lock:
+        if time.time() - _seq['checked'] > configuration.CACHE_CHECK_INTERVAL:
+            _seq['value'] = db.info()['update_seq']
+            _seq['checked'] = time.time()
+        return _seq['value']
+
+
+class NavigationCache(object):
+    """The data for the navigation links: the publication count per year,
+    and the sorted list of PIs. Reloaded when the database has changed,
+    or when older than the TTL, whichever comes first.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        "Force a reload at next access."
+        self.data = None
+        self.update_seq = None
+        self.loaded = 0.0
+
+    def get(self, db):
+        """Get the dictionary with 'years', keyed by year with the count
+        as value, and 'pis', a list of (name, key) sorted by name.
+        """
+        update_seq = get_update_seq(db)
+        with self.lock:
+            if self.data is None or \
+               self.update_seq != update_seq or \
+               time.time() - self.loaded > configuration.NAVIGATION_TTL:
+                self.data = self.load(db)
+                self.update_seq = update_seq
+                self.loaded = time.time()
+            return self.data
+
+    def load(self, db):
+        view = db.view('publication/years', group=True)
+        years = dict([(int(r.key), r.value) for r in view])
+        try:
+            pis = db['pilist']['pis']
+        except couchdb.http.ResourceNotFound:
+            pis = []
+        pis = [(pi['name'], to_ascii(pi['name']).lower().replace(' ', '_'))
+               for pi in pis]
+        pis.sort(key=lambda pi: pi[0].lower())
+        return dict(years=years, pis=pis)
+
+navigation = NavigationCache()
+
+
+class LruCache(object):
+    """Least-recently-used cache, with a budget for the total size
+    of the values. The entries are kept in a circular doubly-linked list,
+    the most recently used last. The methods operating on the entries
+    require the lock to be held by the caller.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.root = root = []           # Entry: [prev, next, key, value, size]
+        root[:] = [root, root, None, None, 0]
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def insert(self, key, value, size):
+        """Add the entry as most recently used, replacing any previous,
+        and evict the least recently used entries if over budget.
+        """
+        self.remove(key)
+        if size > self.maxsize: return
+        root = self.root
+        last = root[0]
+        entry = [last, root, key, value, size]
+        last[1] = root[0] = entry
+        self.entries[key] = entry
+        self.size += size
+        while self.size > self.maxsize:
+            self.remove(root[1][2])
+            self.evictions += 1
+
+    def remove(self, key):
+        "Remove the entry, if any."
+        entry = self.entries.pop(key, None)
+        if entry is None: return
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
+        self.size -= entry[4]
+
+    def move_to_end(self, entry):
+        "Mark the entry as most recently used."
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
+        root = self.root
+        last = root[0]
+        entry[0] = last
+        entry[1] = root
+        last[1] = root[0] = entry
+
+    def get_stats(self):
+        "Get the counters and the size of the cache."
+        with self.lock:
+            lookups = self.hits + self.misses
+            return dict(count=len(self.entries),
+                        size=self.size,
+                        maxsize=self.maxsize,
+                        hits=self.hits,
+                        misses=self.misses,
+                        hit_rate=lookups and float(self.hits)/lookups or 0.0,
+                        evictions=self.evictions)
+
+
+class DocumentCache(LruCache):
+    """LRU cache of documents, keyed by id, with a budget for the total
+    size in bytes of the JSON-encoded documents. Each 'get' returns
+    a fresh copy of the document, which the caller may modify.
+
+    The entries are invalidated by a thread listening to the changes feed
+    of the database, started at first use. An entry is dropped only if
+    the change concerns another revision than the one cached. While the
+    listener is not connected, cached entries are validated by a HEAD
+    request for the current revision.
+    """
+
+    def __init__(self, maxsize):
+        super(DocumentCache, self).__init__(maxsize)
+        self.invalidations = 0
+        self.counter = 0                # Number of changes seen
+        self.changed = dict()           # Counter at last change, keyed by id
+        self.floor = 0
+        self.listener = None
+        self.listening = False
+
+    def get(self, db, id):
+        """Get the document, from the cache if possible.
+        Raise couchdb.http.ResourceNotFound if no such document.
+        """
+        self.start()
+        with self.lock:
+            entry = self.entries.get(id)
+            listening = self.listening
+        if entry is not None and not listening:
+            try:
+                rev = db.resource.head(id)[1].get('etag', '').strip('"')
+            except couchdb.http.ResourceNotFound:
+                rev = None
+            if rev != entry[3][0]:
+                self.invalidate(id)
+                entry = None
+        with self.lock:
+            if entry is not None and self.entries.get(id) is entry:
+                self.hits += 1
+                self.move_to_end(entry)
+                return json.decode(entry[3][1])
+            self.misses += 1
+            token = self.counter
+        doc = db[id]
+        self.put(doc, token=token)
+        return doc
+
+    def get_many(self, db, ids):
+        """Get the documents for the ids, in that order, skipping those
+        not existing. The documents not in the cache are fetched in batches.
+        While the changes listener is not connected, the revisions of the
+        cached documents are validated in one request.
+        """
+        self.start()
+        ids = list(ids)
+        found = dict()
+        with self.lock:
+            for id in ids:
+                entry = self.entries.get(id)
+                if entry is not None:
+                    found[id] = entry
+            listening = self.listening
+        if found and not listening:
+            revisions = get_revisions(db, found.keys())
+            for id, entry in found.items():
+                if revisions.get(id) != entry[3][0]:
+                    self.invalidate(id)
+                    del found[id]
+        with self.lock:
+            for id, entry in found.items():
+                found[id] = json.decode(entry[3][1])
+                if self.entries.get(id) is entry:
+                    self.move_to_end(entry)
+            self.hits += len(found)
+            self.misses += len(ids) - len(found)
+            token = self.counter
+        missing = [id for id in ids if id not in found]
+        for doc in fetch_docs(db, missing):
+            self.put(doc, token=token)
+            found[doc['_id']] = doc
+        return [found[id] for id in ids if id in found]
+
+    def put(self, doc, token=None):
+        """Add the document to the cache. If the token (the change counter
+        before the document was fetched) is given, the document is not
+        added if a change to it has been seen since then.
+        """
+        id = doc.get('_id')
+        if not id or id.startswith('_design/'): return
+        data = json.encode(doc)
+        if len(data) > self.maxsize: return
+        with self.lock:
+            if token is not None:
+                if token < self.floor: return
+                if self.changed.get(id, -1) > token: return
+            self.insert(id, (doc.get('_rev'), data), len(data))
+
+    def invalidate(self, id, rev=None):
+        "Remove the document, unless it has the given revision."
+        with self.lock:
+            self.counter += 1
+            self.changed[id] = self.counter
+            if len(self.changed) > 10000:
+                self.changed.clear()
+                self.floor = self.counter
+            entry = self.entries.get(id)
+            if entry is not None and (rev is None or rev != entry[3][0]):
+                self.remove(id)
+                self.invalidations += 1
+
+    def clear(self):
+        "Remove all documents."
+        with self.lock:
+            for id in self.entries.keys():
+                self.remove(id)
+            self.counter += 1
+            self.floor = self.counter
+
+    def start(self):
+        "Start the changes listener thread, if not done."
+        if self.listener is not None: return
+        with self.lock:
+            if self.listener is not None: return
+            self.listener = threading.Thread(target=self.listen)
+            self.listener.setDaemon(True)
+            self.listener.start()
+
+    def listen(self):
+        """Invalidate the entries for the documents in the changes feed.
+        On failure, the cache is validated by revision until reconnected
+        to the feed, which is resumed from the last change seen.
+        """
+        since = None
+        delay = 1.0
+        while True:
+            try:
+                db = configuration.get_db()
+                if since is None:
+                    since = db.info()['update_seq']
+                    self.clear()
+                changes = db.changes(feed='continuous',
+                                     since=since,
+                                     heartbeat=configuration.CHANGES_HEARTBEAT)
+                self.listening = True
+                for change in changes:
+                    if 'last_seq' in change:
+                        since = change['last_seq']
+                        break
+                    try:
+                        rev = change['changes'][-1]['rev']
+                    except (KeyError, IndexError):
+                        rev = None
+                    if change.get('deleted'):
+                        rev = None
+                    self.invalidate(change['id'], rev)
+                    since = change['seq']
+                    delay = 1.0
+            except Exception, message:
+                if self.listening:
+                    logging.warning("changes listener disconnected: %s",
+                                    message)
+                self.listening = False
+                time.sleep(delay)
+                delay = min(2 * delay, 60.0)
+
+    def get_stats(self):
+        "Get the counters and the size of the cache."
+        result = super(DocumentCache, self).get_stats()
+        result['invalidations'] = self.invalidations
+        result['listening'] = self.listening
+        return result
+
+documents = DocumentCache(configuration.DOCUMENT_CACHE_SIZE)
+
+
+class ResultCache(LruCache):
+    """LRU cache of search results, keyed by the search mode and the
+    normalized terms. Each result is tagged with the update sequence
+    of its source, the database or the text index, when the search was
+    started, and is valid only while the source has not changed since.
+    """
+
+    def get(self, key, update_seq):
+        """Get the result; the list of ids, and whether ranked by relevance.
+        Raise KeyError if not cached or no longer valid.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[3][0] != update_seq:
+                self.misses += 1
+                if entry is not None:
+                    self.remove(key)
+                raise KeyError(key)
+            self.hits += 1
+            self.move_to_end(entry)
+            return list(entry[3][1]), entry[3][2]
+
+    def put(self, key, update_seq, ids, ranked=False):
+        """Add the result for the search; the list of ids, and whether
+        ranked by relevance. The size is an estimate of the memory used.
+        """
+        ids = list(ids)
+        size = 100 + len(repr(key)) + sum([40 + len(id) for id in ids])
+        with self.lock:
+            self.insert(key, (update_seq, ids, ranked), size)
+
+searches = ResultCache(configuration.SEARCH_CACHE_SIZE)
@@ -10,9 +10,12 @@ import socket
 import urllib
 import time
 import datetime
+import threading
 
 import couchdb
 
+from pubrefdb.connection import DatabasePool
+
 
 DEBUG = False
 
@@ -25,6 +28,52 @@ PARENT_LOGO = None                # URL for image for parent page, if any.
 COUCHDB_SERVER   = 'http://localhost:5984/'
 COUCHDB_DATABASE = 'pubrefdb'
 
+COUCHDB_POOL_SIZE      = 10       # Max idle keep-alive connections kept
+COUCHDB_TIMEOUT        = 30.0     # Socket timeout, seconds; None for none
+COUCHDB_IDLE_TIMEOUT   = 300.0    # Close connections idle longer, seconds
+COUCHDB_CHECK_INTERVAL = 60.0     # Database handle health check, seconds
+
+BULK_CHUNK_SIZE = 500             # Number of documents per '_bulk_docs' write
+
+NCBI_API_KEY = None               # NCBI E-utilities API key, if any
+NCBI_EMAIL   = None               # Contact email sent to NCBI, if any
+NCBI_TOOL    = 'pubrefdb'         # Tool name sent to NCBI
+NCBI_RATE    = None               # Requests/second; default 3, 10 with key
+NCBI_RETRIES = 5                  # Retries on HTTP 429 or 5xx responses
+NCBI_BACKOFF = 2.0                # First retry delay, seconds; then doubled
+
+EUTILS_CACHE_DIR  = None          # Dir for cached NCBI responses; None: off
+EUTILS_CACHE_SIZE = 500000000     # Max total size of cached responses, bytes
+EUTILS_CACHE_TTL  = dict(efetch=30*24*3600, # Max age of cached responses,
+                         esearch=3600)      # seconds, per E-utility.
+EUTILS_OFFLINE    = False         # Serve responses only from the cache
+
+FETCH_THREADS = 4                 # Concurrent PubMed requests when fetching
+FETCH_GROUP_SIZE = 20             # PIs handled between fetch checkpoints
+
+FETCH_INTERVAL        = 24*3600   # Scheduler: seconds between PI fetches
+FETCH_INTERVAL_ACTIVE = 6*3600    # Same, for PIs with new publications
+FETCH_JITTER          = 0.1       # Random variation of intervals, fraction
+PATCH_INTERVAL        = 24*3600   # Seconds between patch sweeps when idle
+SCHEDULER_POLL        = 60.0      # Max seconds between scheduler checks
+SCHEDULER_RELOAD      = 600.0     # Seconds between reloads of the PI list
+SCHEDULER_LOCK_FILE   = None      # Default: 'scheduler.lock' in DATA_DIR
+RUN_LOCK_FILE         = None      # Fetch or patch in progress; same, 'run.lock'
+
+CACHE_CHECK_INTERVAL = 5.0        # Max seconds between update_seq checks
+NAVIGATION_TTL = 3600.0           # Max age of navigation links data
+DOCUMENT_CACHE_SIZE = 32*1024*1024 # Max bytes of cached documents, JSON
+SEARCH_CACHE_SIZE = 4*1024*1024   # Max bytes of cached search results
+CHANGES_HEARTBEAT = 10000         # Changes feed heartbeat, milliseconds
+TEXTINDEX_FILE = 'textindex.pickle' # Snapshot, in DATA_DIR if relative;
+                                  # None for none.
+TEXTINDEX_SNAPSHOT_INTERVAL = 300.0 # Min seconds between index snapshots
+SEARCH_PROBE_LIMIT  = 200         # Rows probed per search term lookup
+SEARCH_FILTER_LIMIT = 200         # Max candidates filtered in memory
+SEARCH_THREADS      = 4           # Concurrent search term lookups
+
+DUPLICATES_THRESHOLD = 0.6       # Min Jaccard similarity of duplicates
+
 DATA_DIR = '/var/local/pubrefdb'
 
 DATE_FORMAT     = '%Y-%m-%d'
@@ -75,6 +124,14 @@ else:
 #----------------------------------------------------------------------
 
 
+if not SCHEDULER_LOCK_FILE:
+    SCHEDULER_LOCK_FILE = os.path.join(DATA_DIR, 'scheduler.lock')
+if not RUN_LOCK_FILE:
+    RUN_LOCK_FILE = os.path.join(DATA_DIR, 'run.lock')
+if TEXTINDEX_FILE and not os.path.isabs(TEXTINDEX_FILE):
+    TEXTINDEX_FILE = os.path.join(DATA_DIR, TEXTINDEX_FILE)
+
+
 if DEBUG:
     logging.basicConfig(level=logging.DEBUG)
 else:
@@ -86,13 +143,23 @@ STATIC_DIR = os.path.join(SOURCE_DIR, 'static')
 README_FILE = os.path.join(SOURCE_DIR, 'README.md')
 
 
+_pool = None
+_pool_lock = threading.Lock()
+
 def get_db():
-    "Get an opened database interface instance."
-    server = couchdb.Server(COUCHDB_SERVER)
-    try:
-        return server[COUCHDB_DATABASE]
-    except couchdb.http.ResourceNotFound:
-        raise KeyError('database does not exist')
+    """Get an opened database interface instance.
+    It is shared within the process, reusing the HTTP connections.
+    Raise KeyError if the database does not exist.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = DatabasePool(COUCHDB_SERVER, COUCHDB_DATABASE,
+                                 size=COUCHDB_POOL_SIZE,
+                                 timeout=COUCHDB_TIMEOUT,
+                                 idle_timeout=COUCHDB_IDLE_TIMEOUT,
+                                 check_interval=COUCHDB_CHECK_INTERVAL)
+    return _pool.get()
 
 def get_date(value=None, format=DATE_FORMAT):
     "Get the date in ISO format. Use current local time if value is None."
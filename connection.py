@@ -0,0 +1,117 @@
+""" PubRefDb: Publication database web application.
+
+Process-wide pool of CouchDB connections, shared between requests.
+"""
+
+import logging
+import socket
+import threading
+import time
+
+import couchdb
+
+
+class ConnectionPool(couchdb.http.ConnectionPool):
+    """HTTP connection pool keeping at most 'size' idle keep-alive
+    connections per host, closing those that have been idle too long.
+    """
+
+    def __init__(self, timeout, size=10, idle_timeout=300.0):
+        super(ConnectionPool, self).__init__(timeout)
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.released = dict()          # Release time, keyed by connection
+
+    def get(self, url):
+        self.expire()
+        conn = super(ConnectionPool, self).get(url)
+        self.lock.acquire()
+        try:
+            self.released.pop(conn, None)
+        finally:
+            self.lock.release()
+        return conn
+
+    def release(self, url, conn):
+        scheme, host = couchdb.util.urlsplit(url, 'http', False)[:2]
+        self.lock.acquire()
+        try:
+            conns = self.conns.setdefault((scheme, host), [])
+            if len(conns) >= self.size:
+                conn.close()
+            else:
+                conns.append(conn)
+                self.released[conn] = time.time()
+        finally:
+            self.lock.release()
+
+    def expire(self):
+        "Close the connections which have been idle for too long."
+        limit = time.time() - self.idle_timeout
+        self.lock.acquire()
+        try:
+            for key, conns in self.conns.items():
+                for conn in [c for c in conns
+                             if self.released.get(c, limit) < limit]:
+                    conns.remove(conn)
+                    self.released.pop(conn, None)
+                    conn.close()
+        finally:
+            self.lock.release()
+
+
+class DatabasePool(object):
+    """Database interface shared by all requests in the process.
+    The HTTP session and its keep-alive connections are reused,
+    and the existence of the database is checked only when connecting.
+    The handle is health checked at most every 'check_interval' seconds,
+    and is reconnected if the check fails.
+    """
+
+    def __init__(self, url, name, size=10, timeout=None,
+                 idle_timeout=300.0, check_interval=60.0):
+        self.url = url
+        self.name = name
+        self.size = size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.db = None
+        self.checked = 0.0
+
+    def get(self):
+        "Get the database interface, connecting if required."
+        with self.lock:
+            if self.db is None:
+                self.connect()
+            elif time.time() - self.checked > self.check_interval:
+                try:
+                    self.db.info()
+                except (socket.error, couchdb.http.HTTPError), message:
+                    logging.warning("CouchDB health check failed: %s", message)
+                    self.connect()
+                else:
+                    self.checked = time.time()
+            return self.db
+
+    def connect(self):
+        """Set up a new HTTP session and database interface.
+        Raise KeyError if the database does not exist.
+        """
+        self.db = None
+        session = couchdb.http.Session(timeout=self.timeout)
+        session.connection_pool = ConnectionPool(self.timeout,
+                                                 size=self.size,
+                                                 idle_timeout=self.idle_timeout)
+        server = couchdb.Server(self.url, session=session)
+        try:
+            self.db = server[self.name]
+        except couchdb.http.ResourceNotFound:
+            raise KeyError('database does not exist')
+        self.checked = time.time()
+
+    def reset(self):
+        "Discard the database interface; the next 'get' reconnects."
+        with self.lock:
+            self.db = None
@@ -12,6 +12,9 @@ import couchdb
 from wrapid.utils import now, to_ascii
 
 from pubrefdb import configuration
+from pubrefdb.bulk import iterate_view
+from pubrefdb.cache import documents
+from pubrefdb.lsh import set_band_keys
 
 
 class DocumentSaver(object):
@@ -51,17 +54,145 @@ class DocumentSaver(object):
         if self.entitytype:
             self.doc['modified'] = now()
         self.db.save(self.doc)
+        documents.invalidate(self.doc['_id'])
 
 
 class PublicationSaver(DocumentSaver):
-    "Context handler saving a publication document in the database."
+    """Context handler saving a publication document in the database.
+    The LSH band keys for near-duplicate detection are updated.
+    """
     entitytype = 'publication'
 
+    def __exit__(self, type, value, tb):
+        if type is None:
+            set_band_keys(self.doc)
+        return super(PublicationSaver, self).__exit__(type, value, tb)
+
 class MetadataSaver(DocumentSaver):
     "Context handler saving a metadata document in the database."
     entitytype = 'metadata'
 
 
+class BulkSaver(object):
+    """Context handler saving (update or create) documents in batches,
+    using the CouchDB '_bulk_docs' interface.
+    The documents added are written when the batch is full,
+    and when the context is exited. The documents that could not
+    be saved are recorded as a list of (id, exception) in 'conflicts'.
+    """
+
+    entitytype = None
+
+    def __init__(self, db, chunk_size=None):
+        self.db = db
+        self.chunk_size = chunk_size or configuration.BULK_CHUNK_SIZE
+        self.docs = []
+        self.saved = 0
+        self.conflicts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        if type is not None: return False # No exceptions handled here
+        self.flush()
+
+    def add(self, doc):
+        "Add the document to the batch, writing the batch if full."
+        if not doc.has_key('_id'):
+            doc['_id'] = uuid.uuid4().hex
+            if self.entitytype and not doc.has_key('entitytype'):
+                doc['entitytype'] = self.entitytype
+                doc['created'] = now()
+        if self.entitytype:
+            doc['modified'] = now()
+        self.docs.append(doc)
+        if len(self.docs) >= self.chunk_size:
+            self.flush()
+        return doc
+
+    def flush(self):
+        """Write the current batch of documents.
+        Return the list of (id, exception) for those not saved.
+        """
+        if not self.docs: return []
+        docs = self.docs
+        self.docs = []
+        conflicts = []
+        for success, id, rev_or_exc in self.db.update(docs):
+            if success:
+                self.saved += 1
+            else:
+                conflicts.append((id, rev_or_exc))
+        self.conflicts.extend(conflicts)
+        return conflicts
+
+
+class PublicationBulkSaver(BulkSaver):
+    """Context handler saving publication documents in batches.
+    The LSH band keys for near-duplicate detection are updated.
+    """
+    entitytype = 'publication'
+
+    def add(self, doc):
+        set_band_keys(doc)
+        return super(PublicationBulkSaver, self).add(doc)
+
+
+class XrefSet(object):
+    """Set of the PubMed and DOI xrefs (xdb, xkey) of all publications
+    and excluded publications in the database. It is loaded once from
+    the indexes, and then kept up to date in memory by adding documents,
+    or by updating it from the changes in the database.
+    """
+
+    XDBS = ('pubmed', 'doi')
+
+    def __init__(self, db, chunk_size=5000):
+        self.chunk_size = chunk_size
+        self.load(db)
+
+    def load(self, db):
+        "Load all xrefs from the indexes."
+        self.seq = db.info()['update_seq']
+        self.xrefs = set()
+        for name in ['publication/xref', 'publication/excluded']:
+            for row in iterate_view(db, name, chunk_size=self.chunk_size):
+                self.add_xref(*row.key)
+
+    def update(self, db):
+        """Add the xrefs of the publications and excluded publications
+        saved in the database since loaded or last updated. If any
+        document has been deleted, the xrefs are reloaded instead.
+        """
+        changes = db.changes(since=self.seq, include_docs=True)
+        for change in changes['results']:
+            if change.get('deleted'):
+                self.load(db)
+                return
+            doc = change.get('doc') or dict()
+            if doc.get('entitytype') in ('publication', 'excluded'):
+                self.add(doc)
+        self.seq = changes['last_seq']
+
+    def __len__(self):
+        return len(self.xrefs)
+
+    def __contains__(self, xref):
+        xdb, xkey = xref
+        return (xdb.lower(), xkey) in self.xrefs
+
+    def add_xref(self, xdb, xkey):
+        xdb = xdb.lower()
+        if xdb in self.XDBS:
+            self.xrefs.add((intern(str(xdb)), xkey))
+
+    def add(self, doc):
+        "Add the xrefs of the document."
+        for xref in doc.get('xrefs') or []:
+            self.add_xref(xref['xdb'], xref['xkey'])
+
+
 def load_pilist(db):
     "Load the PI list, if not already done."
     if db.get('pilist'): return
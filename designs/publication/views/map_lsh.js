@@ -0,0 +1,10 @@
+/* PubRefDb: Publication database web application.
+   Index publication documents by LSH band key, for near-duplicate count.
+   Value: 1.
+*/
+function(doc) {
+    if (doc.entitytype !== 'publication') return;
+    for (var i in doc.lsh) {
+	emit(doc.lsh[i], 1);
+    }
+}
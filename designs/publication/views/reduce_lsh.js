@@ -0,0 +1,6 @@
+/* PubRefDb: Publication database web application.
+   Reduce function to obtain the number of publications per LSH band key.
+*/
+function(keys, values, rereduce) {
+    return sum(values);
+}
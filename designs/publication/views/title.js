@@ -3,7 +3,7 @@
    Value: null.
 */
 
-/* Must be kept in sync with search.py */
+/* Must be kept in sync with textindex.py */
 var RSTRIP = /[-\.:,?]$/;
 var IGNORE = {
     'a': 1,
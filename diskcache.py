@@ -0,0 +1,104 @@
+""" PubRefDb: Publication database web application.
+
+Cache of responses stored as files in a directory.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+
+class DiskCache(object):
+    """Cache of data stored as files in a directory, keyed by a string.
+    An entry older than the time-to-live given when getting it is not used.
+    The total size is tracked as entries are added, starting from a scan
+    of the directory at first use. When it exceeds the maximum, the least
+    recently used entries are removed, down to the low-water fraction
+    of the maximum, so the directory is scanned only once in a while.
+    """
+
+    CHUNK_SIZE = 65536
+    LOW_WATER = 0.9
+
+    def __init__(self, dirpath, maxsize):
+        self.dirpath = dirpath
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.size = None                # Unknown until the directory scanned.
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+
+    def get_filepath(self, key):
+        return os.path.join(self.dirpath, hashlib.md5(key).hexdigest())
+
+    def get(self, key, ttl=None):
+        """Return the cached data as an open file, or None if not cached
+        or older than the time-to-live in seconds.
+        """
+        filepath = self.get_filepath(key)
+        try:
+            modified = os.path.getmtime(filepath)
+            if ttl is not None and time.time() - modified > ttl: return None
+            infile = open(filepath, 'rb')
+        except (OSError, IOError):
+            return None
+        os.utime(filepath, (time.time(), modified)) # Access time for LRU.
+        return infile
+
+    def put(self, key, infile):
+        """Store the data read from the file-like object.
+        Return the cached data as an open file.
+        """
+        fd, tmppath = tempfile.mkstemp(dir=self.dirpath, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                while True:
+                    data = infile.read(self.CHUNK_SIZE)
+                    if not data: break
+                    outfile.write(data)
+            size = os.path.getsize(tmppath)
+            filepath = self.get_filepath(key)
+            try:
+                size -= os.path.getsize(filepath)
+            except OSError:
+                pass
+            os.rename(tmppath, filepath)
+        except:
+            os.remove(tmppath)
+            raise
+        with self.lock:
+            if self.size is not None:
+                self.size += size
+        if self.size is None or self.size > self.maxsize:
+            self.evict()
+        return open(filepath, 'rb')
+
+    def evict(self):
+        """Scan the directory for the total size. If above the max size,
+        remove the least recently used entries until within the low-water
+        fraction of it.
+        """
+        with self.lock:
+            entries = []
+            total = 0
+            for filename in os.listdir(self.dirpath):
+                if filename.endswith('.tmp'): continue
+                filepath = os.path.join(self.dirpath, filename)
+                try:
+                    stat = os.stat(filepath)
+                except OSError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, filepath))
+                total += stat.st_size
+            if total > self.maxsize:
+                entries.sort()
+                for accessed, size, filepath in entries:
+                    try:
+                        os.remove(filepath)
+                    except OSError:
+                        pass
+                    total -= size
+                    if total <= self.LOW_WATER * self.maxsize: break
+            self.size = total
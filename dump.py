@@ -1,27 +1,106 @@
 """ PubRefDb: Web application for a database of publications.
 
 Dump all documents having a defined entitytype to a file.
+
+The dump is written as JSON Lines; one document per line.
+The documents are read in chunks, so memory use does not
+depend on the size of the database.
+
+The first line is a header recording the update sequence of the
+database when the dump was made. An incremental dump contains only
+the documents changed since the update sequence of a previous dump,
+including deletions, which are written as '_deleted' stubs.
 """
 
+import gzip
 import json
+import sys
+
+from wrapid.utils import now
 
 from pubrefdb import configuration
+from pubrefdb.bulk import iterate_view
+
+HEADER = 'pubrefdb_dump'
+
+
+def dump(db, outfile, since=None, chunk_size=None, log=True):
+    """Write the documents to the file, one per line, after the header.
+    If 'since' is given, write only the documents changed after
+    that update sequence. Return the count.
+    """
+    header = dict(update_seq=db.info()['update_seq'],
+                  since=since,
+                  created=now())
+    outfile.write(json.dumps({HEADER: header}))
+    outfile.write('\n')
+    if since is None:
+        docs = get_all_docs(db, chunk_size=chunk_size)
+    else:
+        docs = get_changed_docs(db, since, chunk_size=chunk_size)
+    count = 0
+    for doc in docs:
+        outfile.write(json.dumps(doc))
+        outfile.write('\n')
+        count += 1
+        if log and count % 1000 == 0:
+            print >>sys.stderr, count, 'documents'
+    if log:
+        print >>sys.stderr, count, 'documents dumped'
+    return count
+
+def get_all_docs(db, chunk_size=None):
+    "Iterate over all documents having a defined entitytype."
+    for row in iterate_view(db, '_all_docs',
+                            chunk_size=chunk_size,
+                            include_docs=True):
+        doc = row.doc
+        if doc and doc.has_key('entitytype'):
+            yield dict(doc)
 
+def get_changed_docs(db, since, chunk_size=None):
+    """Iterate over the documents changed after the given update sequence,
+    as read from the changes feed. Deleted documents are given as stubs.
+    """
+    chunk_size = chunk_size or configuration.BULK_CHUNK_SIZE
+    while True:
+        data = db.changes(since=since, include_docs=True, limit=chunk_size)
+        for change in data['results']:
+            if change['id'].startswith('_design/'): continue
+            if change.get('deleted'):
+                yield dict(_id=change['id'], _deleted=True)
+            elif change['doc'].has_key('entitytype'):
+                yield change['doc']
+        if not data['results']: break
+        since = data['last_seq']
 
-def dump(db, outfile):
-    data = dict()
-    for id in db:
-        doc = db[id]
-        if doc.has_key('entitytype'):
-            data[doc['_id']] = dict(doc)
-            print id, doc['entitytype']
-    json.dump(data, outfile)
+def open_file(filepath, mode='rb'):
+    "Open the dump file, which is compressed if its name ends with '.gz'."
+    if filepath.endswith('.gz'):
+        return gzip.open(filepath, mode)
+    else:
+        return open(filepath, mode)
 
 
 if __name__ == '__main__':
     import os
+    from pubrefdb.undump import read_dump
     dirpath = os.path.expanduser('~/dumps/pubrefdb')
-    filepath = os.path.join(dirpath, "dump_%s.json" % configuration.get_date())
-    outfile = open(filepath, 'wb')
-    dump(configuration.get_db(), outfile)
+    timestamp = configuration.get_date(format='%Y-%m-%dT%H%M')
+    # Incremental dump if the previous dump file is given.
+    try:
+        previous = sys.argv[1]
+    except IndexError:
+        since = None
+        filename = "dump_%s.jsonl.gz" % timestamp
+    else:
+        infile = open_file(previous)
+        header, docs = read_dump(infile)
+        infile.close()
+        if header is None:
+            sys.exit("no update sequence in %s" % previous)
+        since = header['update_seq']
+        filename = "delta_%s.jsonl.gz" % timestamp
+    outfile = gzip.open(os.path.join(dirpath, filename), 'wb')
+    dump(configuration.get_db(), outfile, since=since)
     outfile.close()
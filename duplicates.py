@@ -0,0 +1,56 @@
+""" PubRefDb: Publication database web application.
+
+List of clusters of near-duplicate publications.
+"""
+
+from .base import *
+from . import minhash
+
+
+class DuplicatesHtmlRepresentation(HtmlRepresentation):
+    "Display the clusters of near-duplicate publications."
+
+    def get_content(self):
+        table = TABLE(TR(TH('Cluster'),
+                         TH('Title'),
+                         TH('Authors'),
+                         TH('Published'),
+                         TH('Xrefs')),
+                      klass='data')
+        for number, cluster in enumerate(self.data['clusters']):
+            for publication in cluster:
+                xrefs = ', '.join(["%(xdb)s:%(xkey)s" % x
+                                   for x in publication.get('xrefs') or []])
+                table.append(TR(TD(str(number+1), klass='integer'),
+                                TD(A(self.safe(publication.get('title')
+                                               or '[no title]'),
+                                     href=publication['href'])),
+                                TD(self.format_authors(publication)),
+                                TD(publication.get('published') or '-'),
+                                TD(self.safe(xrefs) or '-')))
+        return DIV(P("%i clusters." % len(self.data['clusters'])),
+                   table)
+
+
+class Duplicates(MethodMixin, GET):
+    """Clusters of publications which are probably duplicates, having
+    similar titles and authors. Candidates are found using the LSH index,
+    and verified by the Jaccard similarity of title words and authors."""
+
+    outreprs = [JsonRepresentation,
+                DuplicatesHtmlRepresentation]
+
+    def is_accessible(self):
+        return self.is_login_admin()
+
+    def get_data_resource(self, request):
+        threshold = configuration.DUPLICATES_THRESHOLD
+        clusters = minhash.get_clusters(self.db, threshold=threshold)
+        for cluster in clusters:
+            for publication in cluster:
+                self.normalize_publication(publication,
+                                           request.application.get_url)
+        return dict(title='Duplicates',
+                    threshold=threshold,
+                    clusters=clusters,
+                    descr=self.__doc__)
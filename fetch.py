@@ -4,7 +4,8 @@ Fetch new publications from PubMed.
 
 To be executed via cron script or the command line.
 
-The result is recorded in the document 'fetched' in the database.
+The result is recorded in the document 'fetched' in the database,
+together with the date of the last successful search for each PI.
 By default, loop over the current list of PIs for new publications and load.
 If command-line arguments given, then check only those PIs.
 """
@@ -15,10 +16,32 @@ import traceback
 from wrapid.utils import now
 from pubrefdb import pubmed
 from pubrefdb import configuration
-from pubrefdb.database import PublicationSaver
+from pubrefdb import workers
+from pubrefdb.runlock import RunLock
+from pubrefdb.database import PublicationBulkSaver, XrefSet
 
 
-def fetch(db, pinames=[], years=[], delay=10.0):
+def fetch(db, pinames=[], years=[], threads=None, known=None):
+    """Search PubMed for the publications of the PIs, and add the new ones.
+    The xrefs of the publications in the database and of those excluded
+    are used to skip the PMIDs already known. They are loaded once, unless
+    an XrefSet kept between runs is given, which is then brought up to date.
+    The PIs are handled in groups. For each group, the searches are made
+    concurrently, after which the new PMIDs are fetched concurrently
+    in batches and saved in bulk. All requests to NCBI share the rate
+    limit of the process.
+
+    The date of the last successful search for each PI is recorded as
+    a checkpoint after each group. Unless the years are given explicitly,
+    only the publications entered into PubMed since the checkpoint are
+    searched for. PIs without a checkpoint are searched for the previous
+    and current year. An interrupted run thus resumes where it stopped.
+
+    The new PMIDs that could not be fetched are kept in 'missing', keyed
+    by PMID, with the PI, the date and the number of retries, so that they
+    can be fetched again explicitly; see 'retry'. Some are never available,
+    such as book records, so the checkpoints are advanced regardless.
+    """
     try:
         doc = db['fetched']
     except:
@@ -29,37 +52,138 @@ def fetch(db, pinames=[], years=[], delay=10.0):
             del doc['error']
         except KeyError:
             pass
-    if not years:
+    checkpoints = doc.setdefault('checkpoints', dict())
+    unfetched = doc.setdefault('missing', dict())
+    if years:
+        use_checkpoints = False
+    else:
+        use_checkpoints = True
         year = time.localtime().tm_year
         years = range(year-1, year+1)
-    doc['pis'] = []
+    threads = threads or configuration.FETCH_THREADS
+    records = dict([(r['name'], r) for r in doc.get('pis', [])])
     doc['years'] = years
     try:
-        first = True
-        for pi, affiliations in get_pis_affiliations(db, explicit=pinames):
-            record = dict(name=pi)
-            if first:
-                first = False
+        if known is None:
+            known = XrefSet(db)
+        else:
+            known.update(db)
+        pis = get_pis_affiliations(db, explicit=pinames)
+        if not pinames:                 # Drop PIs no longer in the list.
+            names = set([pi for pi, affiliations in pis])
+            for name in records.keys():
+                if name not in names:
+                    del records[name]
+        for group in workers.chunks(pis, configuration.FETCH_GROUP_SIZE):
+            today = time.strftime('%Y/%m/%d')
+            if use_checkpoints:
+                func = lambda pi: search(pi[0], pi[1], years,
+                                         since=checkpoints.get(pi[0]))
             else:
-                time.sleep(delay)
-            pmids = set()
-            for year in years:
-                search = pubmed.Search()
-                for affiliation in affiliations:
-                    pmids.update(search(author=pi,
-                                        affiliation=affiliation,
-                                        published=year))
-            record['count'] = len(pmids)
-            record['added'] = []
-            for pmid in pmids:
-                if add_publication(db, pmid):
-                    record['added'].append(pmid)
-            doc['pis'].append(record)
+                func = lambda pi: search(pi[0], pi[1], years)
+            results = list(workers.imap(func, group, workers=threads))
+            # The PI first in the list gets the credit for a new publication.
+            owners = dict()
+            for (pi, affiliations), pmids in zip(group, results):
+                record = dict(name=pi, count=len(pmids), added=[], missing=[])
+                records[pi] = record
+                for pmid in pmids:
+                    owners.setdefault(pmid, record)
+            pmids = [pmid for pmid in sorted(owners)
+                     if ('pubmed', pmid) not in known]
+            results = workers.imap(get_articles,
+                                   workers.chunks(pmids,
+                                                  pubmed.ArticleBatch.MAX_SIZE),
+                                   workers=threads)
+            with PublicationBulkSaver(db) as saver:
+                for articles, missing in results:
+                    for article in articles:
+                        record = owners.get(article.pmid)
+                        if record is None: continue # Not requested; merged.
+                        data = article.get_data()
+                        set_tags(data)
+                        known.add(saver.add(data))
+                        record['added'].append(article.pmid)
+                        unfetched.pop(article.pmid, None)
+                    for pmid in missing:
+                        record = owners.get(pmid)
+                        if record is not None:
+                            record['missing'].append(pmid)
+                            unfetched.setdefault(pmid, dict(pi=record['name'],
+                                                            date=today,
+                                                            retries=0))
+            if saver.conflicts:
+                raise IOError("could not save %s" %
+                              ', '.join([id for id, exc in saver.conflicts]))
+            if use_checkpoints:
+                for pi, affiliations in group:
+                    checkpoints[pi] = today
+            doc['pis'] = records.values()
+            doc['created'] = now()
+            db.save(doc)
     except Exception, message:
         doc['error'] = traceback.format_exc(limit=20)
+    doc['pis'] = records.values()
     doc['created'] = now()
     db.save(doc)
 
+def retry(db, threads=None):
+    """Fetch again the PMIDs kept as missing in the document 'fetched',
+    and add the publications now found. The PMIDs already known are
+    dropped, and the retry count of those still missing is incremented.
+    Return the number of publications added.
+    """
+    doc = db['fetched']
+    unfetched = doc.get('missing') or dict()
+    known = XrefSet(db)
+    for pmid in unfetched.keys():
+        if ('pubmed', pmid) in known:
+            del unfetched[pmid]
+    results = workers.imap(get_articles,
+                           workers.chunks(sorted(unfetched),
+                                          pubmed.ArticleBatch.MAX_SIZE),
+                           workers=threads or configuration.FETCH_THREADS)
+    with PublicationBulkSaver(db) as saver:
+        for articles, missing in results:
+            for article in articles:
+                if article.pmid not in unfetched: continue
+                data = article.get_data()
+                set_tags(data)
+                known.add(saver.add(data))
+                del unfetched[article.pmid]
+            for pmid in missing:
+                if pmid in unfetched:
+                    unfetched[pmid]['retries'] += 1
+    if saver.conflicts:
+        raise IOError("could not save %s" %
+                      ', '.join([id for id, exc in saver.conflicts]))
+    doc['missing'] = unfetched
+    db.save(doc)
+    return saver.saved
+
+def search(pi, affiliations, years, since=None):
+    """Return the set of PMIDs for the PI and any of the affiliations,
+    using one query. If 'since' is given, then only the publications
+    entered into PubMed from that date, else any of the years.
+    """
+    search = pubmed.Search()
+    if since:
+        pmids = search(author=pi,
+                       affiliation=affiliations,
+                       mindate=since,
+                       maxdate=time.strftime('%Y/%m/%d'))
+    else:
+        pmids = search(author=pi, affiliation=affiliations, published=years)
+    return set(pmids)
+
+def get_articles(pmids):
+    """Fetch the articles for the PMIDs in one batch.
+    Return the list of articles, and the list of PMIDs not found.
+    """
+    batch = pubmed.ArticleBatch(pmids)
+    articles = list(batch)
+    return articles, batch.missing
+
 def get_pis_affiliations(db, explicit=[]):
     """Get the list of (PI name, affiliations).
     If any explicit names given (e.g. from command-line arguments),
@@ -74,29 +198,29 @@ def get_pis_affiliations(db, explicit=[]):
                 pis[i] = None
         pis = [pi for pi in pis if pi is not None]
     return [(pi.get('normalized_name', pi['name']),
-             [a.strip() for a in pi['affiliation'].split(',')])
+             [a.strip() for a in pi['affiliation'].split(',') if a.strip()])
             for pi in pis]
 
-def add_publication(db, pmid):
-    """Add the publication to the database if not already in it.
-    Skip if the PMID has been excluded.
-    Set the tag 'SciLifeLab' if marked such in the affiliation.
+def set_tags(data):
+    """Set the tag 'SciLifeLab' in the publication data
+    if marked such in the affiliation.
     """
-    if len(db.view('publication/xref')[['pubmed', pmid]]) > 0: return
-    if len(db.view('publication/excluded')[['pubmed', pmid]]) > 0: return
-    article = pubmed.Article(pmid)
-    if not article.pmid: return
-    affiliation = article.affiliation or ''
+    affiliation = data.get('affiliation') or ''
     affiliation = affiliation.lower()
     for key in ['science for life laboratory', 'scilifelab']:
         if key in affiliation:
-            article.tags.append('SciLifeLab')
+            data['tags'].append('SciLifeLab')
             break
-    with PublicationSaver(db, doc=article.get_data()) as doc:
-        pass
-    return doc
 
 
 if __name__ == '__main__':
-    import sys
-    fetch(configuration.get_db(), pinames=sys.argv[1:])
+    import optparse
+    parser = optparse.OptionParser(usage='usage: %prog [options] [PI...]')
+    parser.add_option('--retry', action='store_true',
+                      help='fetch again the PMIDs that could not be fetched')
+    options, args = parser.parse_args()
+    with RunLock(configuration.RUN_LOCK_FILE):
+        if options.retry:
+            print retry(configuration.get_db()), 'publications added'
+        else:
+            fetch(configuration.get_db(), pinames=args)
@@ -0,0 +1,143 @@
+""" PubRefDb: Publication database web application.
+
+Ingest publications from local PubMed baseline and update files.
+
+To be executed from the command line, with the XML files (optionally
+gzipped) as arguments, in the order they were released by NCBI.
+
+The files are parsed as streams, using a pool of processes.
+By default, the articles having an author in the PI list, with one
+of the PI's affiliations in the affiliation of the article, are selected.
+If a file of PMIDs (one per line) is given, then the articles in it
+are selected instead.
+Selected articles not in the database are added, unless excluded,
+and the publications already in the database are patched.
+Citations deleted in the update files are not removed.
+"""
+
+import multiprocessing
+import sys
+
+from pubrefdb import pubmed
+from pubrefdb import configuration
+from pubrefdb import workers
+from pubrefdb.database import PublicationBulkSaver, XrefSet
+from pubrefdb.dump import open_file
+from pubrefdb.fetch import get_pis_affiliations, set_tags
+from pubrefdb.patch import update_publication
+
+
+def ingest(db, filepaths, pmids=None, processes=None,
+           chunk_size=None, log=True):
+    """Add or patch the selected articles in the PubMed XML files.
+    If PMIDs are given, select those, else articles by the PIs.
+    The articles are parsed by a pool of processes, by default one
+    per CPU, unless the number of processes is 1, in which case they
+    are parsed in this process.
+    Return the number of articles added and patched.
+    """
+    chunk_size = chunk_size or configuration.BULK_CHUNK_SIZE
+    processes = processes or multiprocessing.cpu_count()
+    if pmids is None:
+        select = PiSelector(get_pis_affiliations(db))
+    else:
+        pmids = set(pmids)
+        select = lambda data: get_pmid(data) in pmids
+    known = XrefSet(db)
+    added = 0
+    patched = 0
+    for filepath in filepaths:
+        if log:
+            print >>sys.stderr, 'Reading', filepath
+        infile = open_file(filepath)
+        try:
+            if processes == 1:
+                articles = (a.get_data() for a in pubmed.iterparse(infile))
+            else:
+                articles = pubmed.iterparse_parallel(infile,
+                                                     processes=processes)
+            articles = (data for data in articles if select(data))
+            for chunk in workers.chunks(articles, chunk_size):
+                added += add_publications(db, chunk, known)
+                patched += patch_publications(db, chunk)
+                if log:
+                    print >>sys.stderr, added, 'added,', patched, 'patched'
+        finally:
+            infile.close()
+    return added, patched
+
+def add_publications(db, chunk, known):
+    """Add the articles whose PMIDs are not known in bulk.
+    Return the number added.
+    """
+    with PublicationBulkSaver(db) as saver:
+        for data in chunk:
+            if ('pubmed', get_pmid(data)) in known: continue
+            set_tags(data)
+            known.add(saver.add(dict(data)))
+    return saver.saved
+
+def patch_publications(db, chunk):
+    """Patch the publications in the database for the articles,
+    looking them up by PMID in one request and saving them in bulk.
+    Return the number patched.
+    """
+    articles = dict()
+    for data in chunk:
+        articles[get_pmid(data)] = data
+    keys = [['pubmed', pmid] for pmid in articles]
+    with PublicationBulkSaver(db) as saver:
+        for row in db.view('publication/xref', keys=keys, include_docs=True):
+            doc = row.doc
+            if update_publication(doc, articles[row.key[1]]):
+                saver.add(doc)
+    return saver.saved
+
+def get_pmid(data):
+    "Get the PMID from the article data."
+    for xref in data['xrefs']:
+        if xref['xdb'].lower() == 'pubmed':
+            return xref['xkey']
+    return None
+
+
+class PiSelector(object):
+    """Select articles having an author in the PI list, where the article
+    affiliation contains any of the affiliations of the PI. The article
+    affiliation includes those given per author.
+    """
+
+    def __init__(self, pis):
+        self.affiliations = dict()
+        for name, affiliations in pis:
+            affiliations = [a.lower() for a in affiliations if a]
+            self.affiliations[name.lower()] = affiliations
+
+    def __call__(self, data):
+        affiliation = (data.get('affiliation') or '').lower()
+        if not affiliation: return False
+        for author in data['authors']:
+            name = "%s %s" % (author.get('lastname_normalized'),
+                              author.get('initials_normalized'))
+            for key in self.affiliations.get(name.lower(), []):
+                if key in affiliation:
+                    return True
+        return False
+
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser(usage='usage: %prog [options] file...')
+    parser.add_option('--pmids', metavar='FILE',
+                      help='select the PMIDs in the file, one per line')
+    parser.add_option('--processes', type='int', metavar='N',
+                      help='number of parsing processes; default one per CPU')
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('no PubMed XML files given')
+    if options.pmids:
+        pmids = [l.strip() for l in open(options.pmids) if l.strip()]
+    else:
+        pmids = None
+    ingest(configuration.get_db(), args,
+           pmids=pmids, processes=options.processes)
@@ -0,0 +1,74 @@
+""" PubRefDb: Publication database web application.
+
+MinHash signatures and locality-sensitive hashing (LSH) band keys
+of publications, for the detection of near-duplicates.
+
+The features of a publication are the normalized words of its title,
+and the keys (last name and first initial) of its authors. The MinHash
+signature of the features is split into bands, and the hash of each band
+is a band key. The band keys are stored as 'lsh' in the publication
+document when it is saved, and are indexed by the view 'publication/lsh'.
+"""
+
+import random
+import re
+import zlib
+
+from wrapid.utils import to_ascii
+
+
+BANDS = 16
+ROWS = 4                                # Changing any requires a rebuild.
+
+PRIME = (1 << 61) - 1
+_random = random.Random(1731)
+COEFFICIENTS = [(_random.randint(1, PRIME - 1), _random.randint(0, PRIME - 1))
+                for i in xrange(BANDS * ROWS)]
+
+WORD = re.compile(r'[a-z0-9]+')
+
+
+def get_features(doc):
+    """Get the set of features of the publication: the title words,
+    and the author keys prefixed by 'a:'.
+    """
+    features = set()
+    title = to_ascii(doc.get('title') or '').lower()
+    for word in WORD.findall(title):
+        if len(word) > 1:
+            features.add(word)
+    for author in doc.get('authors') or []:
+        name = author.get('lastname_normalized') or author.get('lastname')
+        if not name: continue
+        initials = author.get('initials_normalized') or \
+                   author.get('initials') or ''
+        features.add("a:%s %s" % (to_ascii(name).lower(),
+                                  to_ascii(initials[:1]).lower()))
+    return features
+
+def get_signature(features):
+    "Get the MinHash signature of the features; a list of integers."
+    hashes = [zlib.crc32(f) & 0xffffffff for f in features]
+    return [min([(a * h + b) % PRIME for h in hashes])
+            for a, b in COEFFICIENTS]
+
+def get_band_keys(features):
+    "Get the band keys for the features; an empty list if none."
+    if not features: return []
+    signature = get_signature(features)
+    result = []
+    for band in xrange(BANDS):
+        rows = signature[band*ROWS:(band+1)*ROWS]
+        key = zlib.crc32(','.join([str(r) for r in rows])) & 0xffffffff
+        result.append("%02d%08x" % (band, key))
+    return result
+
+def set_band_keys(doc):
+    "Set the band keys in the publication document."
+    doc['lsh'] = get_band_keys(get_features(doc))
+
+def get_jaccard(features1, features2):
+    "Get the Jaccard similarity of the two sets of features."
+    union = len(features1 | features2)
+    if not union: return 0.0
+    return len(features1 & features2) / float(union)
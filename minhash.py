@@ -0,0 +1,111 @@
+""" PubRefDb: Publication database web application.
+
+Detection of near-duplicate publications, using the MinHash signatures
+and locality-sensitive hashing (LSH) band keys set by the module 'lsh'.
+Publications sharing any band key are candidate duplicates; those
+whose features are similar enough are grouped into clusters.
+
+To be executed from the command line: set the band keys for all
+publications (option --build), and list the clusters of duplicates.
+"""
+
+import sys
+
+from wrapid.utils import to_ascii
+
+from pubrefdb import configuration
+from pubrefdb import workers
+from pubrefdb.bulk import iterate_view, fetch_docs
+from pubrefdb.database import BulkSaver
+from pubrefdb.lsh import get_features, get_jaccard, set_band_keys
+
+
+def get_buckets(db, chunk_size=None):
+    "Get the band keys shared by more than one publication."
+    return [row.key for row in iterate_view(db, 'publication/lsh',
+                                            chunk_size=chunk_size,
+                                            group=True)
+            if row.value > 1]
+
+def get_clusters(db, threshold=None, chunk_size=None):
+    """Get the clusters of near-duplicate publications, as lists
+    of documents sorted by title. The candidates sharing a band key
+    are grouped if the Jaccard similarity of their features is at least
+    the threshold. Only the candidates are fetched from the database.
+    """
+    threshold = threshold or configuration.DUPLICATES_THRESHOLD
+    chunk_size = chunk_size or configuration.BULK_CHUNK_SIZE
+    buckets = dict()
+    for keys in workers.chunks(get_buckets(db, chunk_size=chunk_size),
+                               chunk_size):
+        for row in db.view('publication/lsh', keys=keys, reduce=False):
+            buckets.setdefault(row.key, []).append(row.id)
+    docs = dict()
+    ids = set()
+    for bucket in buckets.values():
+        ids.update(bucket)
+    for doc in fetch_docs(db, sorted(ids), chunk_size=chunk_size):
+        docs[doc['_id']] = doc
+    features = dict([(id, get_features(doc)) for id, doc in docs.items()])
+    parents = dict()
+    def find(id):
+        while parents.get(id, id) != id:
+            id = parents[id]
+        return id
+    compared = set()
+    for bucket in buckets.values():
+        bucket = sorted([id for id in set(bucket) if id in docs])
+        for i, id1 in enumerate(bucket):
+            for id2 in bucket[i+1:]:
+                if (id1, id2) in compared: continue
+                compared.add((id1, id2))
+                if get_jaccard(features[id1], features[id2]) >= threshold:
+                    parents[find(id2)] = find(id1)
+    clusters = dict()
+    for id in set(parents).union(parents.values()):
+        clusters.setdefault(find(id), []).append(docs[id])
+    result = []
+    for cluster in clusters.values():
+        cluster.sort(key=lambda d: (d.get('title') or '').lower())
+        result.append(cluster)
+    result.sort(key=lambda c: (c[0].get('title') or '').lower())
+    return result
+
+def build(db, chunk_size=None, log=True):
+    """Set the band keys for all publications, saving in bulk
+    those whose keys have changed. Return the number saved.
+    """
+    with BulkSaver(db, chunk_size=chunk_size) as saver:
+        for row in iterate_view(db, 'publication/modified',
+                                chunk_size=chunk_size,
+                                include_docs=True):
+            doc = row.doc
+            keys = doc.get('lsh')
+            set_band_keys(doc)
+            if doc['lsh'] != keys:
+                saver.add(doc)
+    if log:
+        print >>sys.stderr, saver.saved, 'publications updated'
+    return saver.saved
+
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--build', action='store_true',
+                      help='set the band keys for all publications first')
+    parser.add_option('--threshold', type='float', metavar='J',
+                      help='minimum Jaccard similarity; default %s' %
+                      configuration.DUPLICATES_THRESHOLD)
+    options, args = parser.parse_args()
+    db = configuration.get_db()
+    if options.build:
+        build(db)
+    for cluster in get_clusters(db, threshold=options.threshold):
+        for doc in cluster:
+            xrefs = ', '.join(["%s:%s" % (x['xdb'], x['xkey'])
+                               for x in doc.get('xrefs') or []])
+            print "%s  %s  %s" % (doc['_id'], doc.get('published') or '-',
+                                  xrefs or '-')
+            print "  ", to_ascii(doc.get('title') or '')
+        print
@@ -6,29 +6,51 @@ To be executed via cron, the command line or via the 'Update from PubMed'
 operation in the web interface.
 """
 
-import time
-
 from pubrefdb import pubmed
 from pubrefdb import configuration
-from pubrefdb.database import PublicationSaver
+from pubrefdb import workers
+from pubrefdb.runlock import RunLock
+from pubrefdb.database import PublicationSaver, PublicationBulkSaver
+from pubrefdb.bulk import iterate_view
+
+FIELDS = ('type', 'published', 'journal')
 
 
-def patch(db, delay=10.0, log=True):
-    """Loop through all publications lacking information.
+def patch(db, log=True):
+    """Loop through all publications lacking information, in batches.
     Skip publications not having a PubMed xref.
     Attempt to patch up the following missing bits of information:
     type of publication, published date and journal information.
+    The articles for a batch are fetched from PubMed in one request,
+    and the changed publications are saved in one bulk request.
+    Return the number of publications changed per field.
     """
-    view = db.view('publication/incomplete', include_docs=True)
-    for item in view:
-        pmid = item.value
-        if not pmid: continue
+    counts = dict([(key, 0) for key in FIELDS])
+    rows = iterate_view(db, 'publication/incomplete', include_docs=True)
+    rows = (row for row in rows if row.value)
+    for chunk in workers.chunks(rows, pubmed.ArticleBatch.MAX_SIZE):
+        docs = dict()
+        for row in chunk:
+            docs.setdefault(row.value, []).append(row.doc)
+        if log:
+            print 'Checking', len(docs), 'PMIDs'
+        with PublicationBulkSaver(db, chunk_size=len(chunk)) as saver:
+            for article in pubmed.ArticleBatch(docs.keys()):
+                for doc in docs[article.pmid]:
+                    changed = update_publication(doc, article.get_data())
+                    if not changed: continue
+                    for key in changed:
+                        counts[key] += 1
+                    saver.add(doc)
+                    if log:
+                        print 'Updated', article.pmid, article.title
         if log:
-            print 'Checking PMID', pmid
-        article = pubmed.Article(pmid)
-        if article.pmid:
-            patch_publication(db, item.doc, article, log=log)
-            time.sleep(delay)
+            for id, exc in saver.conflicts:
+                print 'Error', id, exc
+    if log:
+        for key in FIELDS:
+            print 'Changed', key, counts[key]
+    return counts
 
 
 def patch_publication(db, doc, article, log):
@@ -36,16 +58,28 @@ def patch_publication(db, doc, article, log):
        doc['published'] != article.published or \
        doc['journal'] != article.journal:
         with PublicationSaver(db, doc=doc):
-            doc['type'] = article.type
-            doc['published'] = article.published
-            doc['journal'] = article.journal
+            update_publication(doc, article.get_data())
             if log:
                 print 'Updated', article.pmid, article.title
     return doc
 
 
+def update_publication(doc, data):
+    """Set type of publication, published date and journal information
+    in the document from the article data. Return the list of changed fields.
+    """
+    changed = []
+    for key in FIELDS:
+        value = data.get(key)
+        if doc.get(key) != value:
+            doc[key] = value
+            changed.append(key)
+    return changed
+
+
 if __name__ == '__main__':
     import os
     import sys
     db = configuration.get_db()
-    patch(db, log=os.isatty(sys.stdin.fileno()))
+    with RunLock(configuration.RUN_LOCK_FILE):
+        patch(db, log=os.isatty(sys.stdin.fileno()))
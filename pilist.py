@@ -5,6 +5,7 @@ Edit list of PIs (authors for navigation menu links).
 
 from .base import *
 from .database import MetadataSaver
+from .cache import navigation
 
 
 class EditPiList(MethodMixin, GET):
@@ -100,4 +101,5 @@ class ModifyPiList(MethodMixin, RedirectMixin, POST):
                                         affiliation=values.get('affiliation') or '')
         with saver:
             doc['pis'] = [pis[key] for key in sorted(pis.keys())]
+        navigation.clear()
         self.set_redirect(request.get_url())
@@ -233,6 +233,7 @@ class DeletePublication(EditMixin, MethodMixin, RedirectMixin, DELETE):
         shutil.rmtree(os.path.join(configuration.DATA_DIR, iui),
                       ignore_errors=True)
         del self.db[iui]
+        documents.invalidate(iui)
         self.set_redirect(request.application.url)
 
 
@@ -749,8 +750,28 @@ class FetchedHtmlRepresentation(HtmlRepresentation):
                             TD(str(pi['count']), klass='integer'),
                             TD(', '.join([str(A(p['pmid'], href=p['href']))
                                           for p in pi.get('added', [])]))))
+        scheduler = self.data.get('scheduler')
+        if scheduler:
+            last_run = scheduler.get('last_run') or dict()
+            scheduler = P("Scheduler: %s PIs queued, next fetch %s."
+                          " Last run: %s %s, %s." %
+                          (scheduler.get('queue'),
+                           scheduler.get('next') or '-',
+                           last_run.get('kind', '-'),
+                           last_run.get('finished', ''),
+                           last_run.get('status', '-')))
+        else:
+            scheduler = ''
+        missing = fetched.get('missing')
+        if missing:
+            missing = P("%s PMIDs could not be fetched; retry by"
+                        " 'fetch.py --retry'." % len(missing))
+        else:
+            missing = ''
         return DIV(error,
                    P("Fetched %s" % fetched.get('created')),
+                   scheduler,
+                   missing,
                    table)
 
 
@@ -777,8 +798,17 @@ class FetchedPubmedPublications(MethodMixin, GET):
             for pi in doc['pis']:
                 pi['added'] = [dict(pmid=a, href=get_url('pubmed', a))
                                for a in pi.get('added', [])]
+        try:
+            scheduler = self.db['scheduler']
+        except couchdb.http.ResourceNotFound:
+            scheduler = dict()
+        else:
+            scheduler.pop('_id', None)
+            scheduler.pop('_rev', None)
+            scheduler.pop('entitytype', None)
         return dict(title='New publications fetched from PubMed',
-                    fetched=doc)
+                    fetched=doc,
+                    scheduler=scheduler)
 
 
 class XrefPublication(MethodMixin, RedirectMixin, GET):
@@ -3,17 +3,28 @@
 PubMed interface.
 """
 
+import logging
+import multiprocessing
+import os.path
+import threading
 import time
 import urllib
+import urllib2
 import unicodedata
+import urlparse
 import xml.etree.ElementTree
 
+from pubrefdb import configuration
+from pubrefdb import workers
+from pubrefdb.diskcache import DiskCache
+
 
 MONTHS = dict(jan=1, feb=2, mar=3, apr=4, may=5, jun=6,
               jul=7, aug=8, sep=9, oct=10, nov=11, dec=12)
 
 PUBMED_FETCH_URL = 'http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pubmed&rettype=abstract&id=%s'
-PUBMED_SEARCH_URL = 'http://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pubmed&retmax=%s&term=%s'
+PUBMED_EFETCH_URL = 'http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi'
+PUBMED_ESEARCH_URL = 'http://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi'
 
 
 def to_ascii(value):
@@ -21,6 +32,269 @@ def to_ascii(value):
     value = unicode(value)
     return unicodedata.normalize('NFKD', value).encode('ascii', 'ignore')
 
+class RateLimiter(object):
+    """Token bucket limiting the rate of requests; shared between threads.
+    At most 'burst' requests may be made at once, and tokens are
+    replenished at 'rate' per second.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        "Wait until a request may be made."
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, delay):
+        "Hold back all requests for at least the given number of seconds."
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate,
+                              0.0) - delay * self.rate
+            self.updated = now
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+def get_limiter():
+    """Get the rate limiter for NCBI E-utilities shared by the process.
+    The rate is as allowed by NCBI, unless set in the configuration.
+    """
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            rate = configuration.NCBI_RATE
+            if not rate:
+                if configuration.NCBI_API_KEY:
+                    rate = 10
+                else:
+                    rate = 3
+            _limiter = RateLimiter(rate)
+    return _limiter
+
+def get_params():
+    "Get the identification parameters for NCBI E-utilities requests."
+    params = [('tool', configuration.NCBI_TOOL),
+              ('email', configuration.NCBI_EMAIL),
+              ('api_key', configuration.NCBI_API_KEY)]
+    return [(key, value) for key, value in params if value]
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    "Get the response cache, or None if not configured."
+    global _cache
+    with _cache_lock:
+        if _cache is None and configuration.EUTILS_CACHE_DIR:
+            _cache = DiskCache(configuration.EUTILS_CACHE_DIR,
+                               configuration.EUTILS_CACHE_SIZE)
+    return _cache
+
+def get_cache_key(url, data=None):
+    """Get the cache key for the request; the URL with the parameters
+    of both the query and the POST data in sorted order.
+    Note that the requests for the further pages of an esearch result
+    include the WebEnv of the history server session, which differs for
+    each new search. The cached pages are therefore hit only while the
+    cached first response, which gave that WebEnv, is used; once it has
+    expired, all pages are fetched anew, and the old ones are left to be
+    evicted. In offline mode, a search is replayed only if all its pages
+    were cached in the same session as its first response.
+    """
+    parts = urlparse.urlsplit(url)
+    params = urlparse.parse_qsl(parts.query)
+    if data:
+        params.extend(urlparse.parse_qsl(data))
+    params.sort()
+    return "%s://%s%s?%s" % (parts.scheme, parts.netloc, parts.path,
+                             urllib.urlencode(params))
+
+def get_response(url, data=None):
+    """Open the response from PubMed as a file-like object.
+    The request is a POST if data is given.
+    If a cache directory is configured, a response is reused
+    while younger than the time-to-live for its E-utility.
+    In offline mode, responses are served only from the cache.
+    The rate of requests is limited, and a request is retried with
+    increasing delays if NCBI responds with HTTP 429 (too many requests)
+    or a server error.
+    """
+    cache = get_cache()
+    if cache:
+        key = get_cache_key(url, data)
+        if configuration.EUTILS_OFFLINE:
+            ttl = None
+        else:
+            utility = os.path.splitext(urlparse.urlsplit(url).path)[0]
+            utility = os.path.basename(utility)
+            ttl = configuration.EUTILS_CACHE_TTL.get(utility, 0)
+        infile = cache.get(key, ttl)
+        if infile:
+            return infile
+    if configuration.EUTILS_OFFLINE:
+        raise IOError("offline; response not in cache: %s" % url)
+    params = urllib.urlencode(get_params())
+    if params:
+        if data is None:
+            url += ('?' in url and '&' or '?') + params
+        else:
+            data += '&' + params
+    limiter = get_limiter()
+    delay = configuration.NCBI_BACKOFF
+    retries = configuration.NCBI_RETRIES
+    while True:
+        limiter.acquire()
+        try:
+            response = urllib2.urlopen(url, data)
+        except urllib2.HTTPError, error:
+            if error.code != 429 and error.code < 500:
+                raise IOError("HTTP error %s" % error.code)
+            if retries <= 0:
+                raise IOError("HTTP error %s; giving up" % error.code)
+            try:
+                wait = max(delay, float(error.headers.get('Retry-After')))
+            except (TypeError, ValueError):
+                wait = delay
+            logging.warning("NCBI HTTP error %s; retry in %s seconds",
+                            error.code, wait)
+            limiter.pause(wait)
+            delay *= 2
+            retries -= 1
+        else:
+            if cache:
+                return cache.put(key, response)
+            else:
+                return response
+
+def get_xml(url, data=None):
+    """Fetch the XML from PubMed and parse into an ElementTree.
+    The request is a POST if data is given.
+    """
+    data = get_response(url, data).read()
+    try:
+        return xml.etree.ElementTree.fromstring(data)
+    except:
+        print data
+        raise
+
+
+def iterparse(source):
+    """Iterate over the articles in the PubMed XML from the source,
+    a filename or file object. Each PubmedArticle element is parsed
+    into an Article as soon as its end tag has been read, and is then
+    discarded, so memory use does not depend on the number of articles.
+    Articles that cannot be parsed are skipped.
+    """
+    root = None
+    for event, element in xml.etree.ElementTree.iterparse(source,
+                                                          ('start', 'end')):
+        if root is None:
+            root = element
+        if event != 'end' or element.tag != 'PubmedArticle': continue
+        article = Article()
+        try:
+            article.parse(element)
+        except Exception, message:      # Any bad record; skip only it.
+            logging.warning("skipped unparseable PubMed article %s: %s",
+                            element.findtext('MedlineCitation/PMID'),
+                            message)
+            article = None
+        root.clear()                    # Discard all elements read so far.
+        if article is not None:
+            yield article
+
+
+def iterelements(source, size=1048576):
+    """Iterate over the XML text of the PubmedArticle elements in the
+    PubMed XML from the source, a filename or file object. The text is
+    split at the tags of the elements as it is read, without parsing,
+    so that all parsing can be done elsewhere.
+    """
+    if isinstance(source, basestring):
+        infile = open(source, 'rb')
+    else:
+        infile = source
+    start = '<PubmedArticle>'
+    end = '</PubmedArticle>'
+    buffer = ''
+    try:
+        while True:
+            data = infile.read(size)
+            buffer += data
+            offset = 0
+            while True:
+                first = buffer.find(start, offset)
+                if first < 0:
+                    buffer = buffer[max(offset, len(buffer) - len(start)):]
+                    break
+                last = buffer.find(end, first)
+                if last < 0:
+                    buffer = buffer[first:]
+                    break
+                offset = last + len(end)
+                yield buffer[first:offset]
+            if not data: break
+    finally:
+        if infile is not source:
+            infile.close()
+
+def parse_article(text):
+    """Parse the XML text for a PubmedArticle element into article data.
+    Return None if it cannot be parsed.
+    """
+    article = Article()
+    try:
+        article.parse(xml.etree.ElementTree.fromstring(text))
+    except Exception, message:          # As in 'iterparse'.
+        logging.warning("skipped unparseable PubMed article: %s", message)
+        return None
+    return article.get_data()
+
+def iterparse_parallel(source, processes=None, chunksize=50):
+    """Iterate over the article data in the PubMed XML from the source,
+    a filename or file object. The text of the articles is split out
+    in this process, and is parsed in a pool of processes. The article
+    data is produced in the order of the source. At most
+    two windows of articles are in progress at any time, so memory use
+    does not depend on the number of articles.
+    Articles that cannot be parsed are skipped.
+    """
+    pool = multiprocessing.Pool(processes)
+    size = chunksize * 4 * (processes or multiprocessing.cpu_count())
+    try:
+        pending = None
+        for window in workers.chunks(iterelements(source), size):
+            result = pool.map_async(parse_article, window, chunksize)
+            if pending is not None:
+                for data in pending.get():
+                    if data is not None:
+                        yield data
+            pending = result
+        if pending is not None:
+            for data in pending.get():
+                if data is not None:
+                    yield data
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
 
 class Article(object):
     "Fetch and parse PubMed XML for a publication given by its PMID."
@@ -65,17 +339,7 @@ class Article(object):
 
     def fetch(self, pmid):
         "Fetch the XML from PubMed and parse into an ElementTree."
-        url = PUBMED_FETCH_URL % pmid
-        infile = urllib.urlopen(url)
-        code = infile.getcode() 
-        if code < 200 or code >= 400:
-            raise IOError("HTTP error %s" % code)
-        data = infile.read()
-        try:
-            return xml.etree.ElementTree.fromstring(data)
-        except:
-            print data
-            raise
+        return get_xml(PUBMED_FETCH_URL % urllib.quote(str(pmid).strip()))
 
     def parse(self, tree):
         "Parse the XML tree for the article information."
@@ -85,7 +349,7 @@ class Article(object):
             raise ValueError('invalid XML')
         self.title = element.findtext('ArticleTitle') or '[no title]'
         self.authors = self.get_authors(element.find('AuthorList'))
-        self.affiliation = element.findtext('Affiliation') or None
+        self.affiliation = self.get_affiliation(element)
         self.journal = self.get_journal(element)
         self.type = self.get_type(element)
         self.published = self.get_published(tree)
@@ -97,6 +361,7 @@ class Article(object):
 
     def get_authors(self, authorlist):
         result = []
+        if authorlist is None: return result # Anonymous; editorial etc.
         existing = set()                # Handle pathological multi-mention.
         for element in authorlist.findall('Author'):
             author = dict()
@@ -128,12 +393,26 @@ class Article(object):
                 author['forename_normalized'] = None
                 author['initials_normalized'] = None
             if author:
-                key = "%(lastname)s %(forename)s" % author
+                key = "%s %s" % (author.get('lastname'), author.get('forename'))
                 if key not in existing:
                     result.append(author)
                     existing.add(key)
         return result
 
+    def get_affiliation(self, article):
+        """Get the affiliation of the article. Current PubMed XML has
+        the affiliations only per author, in which case the distinct
+        ones are joined, in order of appearance.
+        """
+        affiliation = article.findtext('Affiliation')
+        if affiliation: return affiliation
+        result = []
+        for element in article.findall('AuthorList/Author/AffiliationInfo/Affiliation'):
+            affiliation = (element.text or '').strip()
+            if affiliation and affiliation not in result:
+                result.append(affiliation)
+        return '; '.join(result) or None
+
     def get_journal(self, article):
         result = dict()
         element = article.find('Journal')
@@ -233,28 +512,140 @@ class Article(object):
         return result
 
 
+class ArticleBatch(object):
+    """Fetch and parse PubMed XML for a batch of publications given by
+    their PMIDs, using a single request. Iterating over the batch yields
+    an Article for each publication found. After the iteration, the PMIDs
+    not found or not possible to parse are listed in 'missing'.
+    """
+
+    MAX_SIZE = 200
+
+    def __init__(self, pmids):
+        self.pmids = []
+        existing = set()
+        for pmid in pmids:
+            pmid = str(pmid).strip()
+            if pmid and pmid not in existing:
+                self.pmids.append(pmid)
+                existing.add(pmid)
+        if len(self.pmids) > self.MAX_SIZE:
+            raise ValueError("too many PMIDs in batch; max %s" % self.MAX_SIZE)
+        self.missing = []
+
+    def __str__(self):
+        return "ArticleBatch(%s)" % ','.join(self.pmids)
+
+    def __iter__(self):
+        found = set()
+        if self.pmids:
+            requested = set(self.pmids)
+            for article in iterparse(self.fetch()):
+                if article.pmid not in requested: continue
+                if article.pmid in found: continue
+                found.add(article.pmid)
+                yield article
+        self.missing = [p for p in self.pmids if p not in found]
+
+    def fetch(self):
+        """Open the response for all PMIDs in the batch in one POST request.
+        The XML is parsed as it is read.
+        """
+        data = urllib.urlencode(dict(db='pubmed',
+                                     rettype='abstract',
+                                     id=','.join(self.pmids)))
+        return get_response(PUBMED_EFETCH_URL, data)
+
+
 class Search(object):
-    "Simple search interface, producing a list of PMIDs."
+    """Search interface, producing a list of PMIDs.
+    The query is run on the NCBI history server, and the result is
+    retrieved in pages of 'retmax' PMIDs, so it is never truncated.
+    """
 
-    def __init__(self, retmax=100):
+    def __init__(self, retmax=1000):
         self.retmax = retmax
 
     def __call__(self, author=None, published=None, journal=None,
-                 affiliation=None, words=None):
+                 affiliation=None, words=None,
+                 mindate=None, maxdate=None, datetype='edat'):
+        """Return the list of all PMIDs for the query.
+        The optional date window 'YYYY/MM/DD' applies to the date type;
+        by default the date the publication was entered into PubMed.
+        """
+        query = self.get_query(author=author,
+                               published=published,
+                               journal=journal,
+                               affiliation=affiliation,
+                               words=words)
+        params = dict()
+        if mindate or maxdate:
+            params['mindate'] = mindate or '1900/01/01'
+            params['maxdate'] = maxdate or time.strftime('%Y/%m/%d')
+            params['datetype'] = datetype
+        history, pmids = self.post(query, **params)
+        for retstart in xrange(len(pmids), history['count'], self.retmax):
+            pmids.extend(self.get_page(history, retstart))
+        return pmids
+
+    def get_query(self, author=None, published=None, journal=None,
+                  affiliation=None, words=None):
+        """Get the query string. The published year and the affiliation
+        may be lists, in which case any of the values may match.
+        Empty values are ignored.
+        """
         parts = []
         if author:
             parts.append("%s[Author]" % to_ascii(author))
         if published:
-            parts.append("%s[PDAT]" % published)
+            parts.append(self.get_any('%s[PDAT]', published))
         if journal:
             parts.append("%s[Journal]" % journal)
         if affiliation:
-            parts.append("%s[Affiliation]" % to_ascii(affiliation))
+            parts.append(self.get_any('%s[Affiliation]', affiliation))
         if words:
-            parts.append(words.replace(' ', '+'))
-        url = PUBMED_SEARCH_URL % (self.retmax, ' AND '.join(parts))
-        data = urllib.urlopen(url).read()
-        root = xml.etree.ElementTree.fromstring(data)
+            parts.append(words)
+        return ' AND '.join([p for p in parts if p])
+
+    def get_any(self, format, values):
+        """Get the query part where any of the values may match.
+        Return None if all values are empty.
+        """
+        if isinstance(values, (basestring, int)):
+            values = [values]
+        values = [to_ascii(v).strip() for v in values]
+        parts = [format % v for v in values if v]
+        if not parts:
+            return None
+        if len(parts) == 1:
+            return parts[0]
+        return "(%s)" % ' OR '.join(parts)
+
+    def post(self, query, **params):
+        """Run the query on the history server. Return the history
+        as a dictionary with 'count', 'webenv' and 'query_key',
+        and the first page of PMIDs. Any other esearch parameters
+        may be given as keyword arguments.
+        """
+        params.update(db='pubmed',
+                      term=query,
+                      usehistory='y',
+                      retmax=self.retmax)
+        root = get_xml(PUBMED_ESEARCH_URL, urllib.urlencode(params))
+        history = dict(count=int(root.findtext('Count') or 0),
+                       webenv=root.findtext('WebEnv'),
+                       query_key=root.findtext('QueryKey'))
+        return history, [e.text for e in root.findall('IdList/Id')]
+
+    def get_page(self, history, retstart):
+        "Get the page of PMIDs from the history starting at the offset."
+        root = get_xml(PUBMED_ESEARCH_URL,
+                       urllib.urlencode(dict(db='pubmed',
+                                             term="#%s" % history['query_key'],
+                                             WebEnv=history['webenv'],
+                                             usehistory='y',
+                                             retstart=retstart,
+                                             retmax=self.retmax)))
         return [e.text for e in root.findall('IdList/Id')]
 
 
@@ -280,8 +671,6 @@ if __name__ == '__main__':
     ## data = infile.read()
     ## open('data/melkersson_2012.xml', 'w').write(data)
     import json
-    root = xml.etree.ElementTree.fromstring(open('data/melkersson_2012.xml').read())
-    article = Article()
-    article.parse(root.find('PubmedArticle'))
-    ## article=Article(pmid='11751858')
-    print json.dumps(article.get_data(), indent=2)
+    for article in iterparse('data/melkersson_2012.xml'):
+        ## article=Article(pmid='11751858')
+        print json.dumps(article.get_data(), indent=2)
@@ -0,0 +1,49 @@
+""" PubRefDb: Publication database web application.
+
+Lock file preventing overlapping runs of batch jobs.
+"""
+
+import fcntl
+import os
+
+
+class RunLock(object):
+    """Context handler holding an exclusive lock on the file.
+    Raise IOError on entry if some other process holds the lock.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.lockfile = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.release()
+        return False
+
+    def acquire(self):
+        "Lock the file, not following a symbolic link in its place."
+        try:
+            fd = os.open(self.filepath,
+                         os.O_WRONLY | os.O_CREAT | os.O_NOFOLLOW, 0644)
+        except OSError, message:
+            raise IOError("cannot open lock file: %s" % message)
+        lockfile = os.fdopen(fd, 'w')
+        try:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lockfile.close()
+            raise IOError("locked by another process: %s" % self.filepath)
+        lockfile.truncate(0)
+        lockfile.write("%s\n" % os.getpid())
+        lockfile.flush()
+        self.lockfile = lockfile
+
+    def release(self):
+        if self.lockfile is None: return
+        fcntl.flock(self.lockfile.fileno(), fcntl.LOCK_UN)
+        self.lockfile.close()
+        self.lockfile = None
@@ -0,0 +1,229 @@
+""" PubRefDb: Publication database web application.
+
+Scheduler service fetching new publications from PubMed, replacing
+the cron-driven scripts.
+
+To be executed as a long-running process, for instance from an init
+script. Only one scheduler may run at any time.
+
+Each PI in the PI list is fetched on its own schedule, with some random
+jitter to spread the load on NCBI. PIs which got new publications
+in their last fetch are considered active, and are fetched more often.
+When no fetch is due, incomplete publications are patched, if not done
+recently. Runs are serialized with the lock shared with the fetch and
+patch scripts, so they never overlap.
+
+The xrefs of the publications in the database, used to skip the PMIDs
+already known, are loaded at the first fetch, and are then kept up to date
+from the changes in the database.
+
+The queue depth and the status of the last run are recorded in the
+document 'scheduler' in the database.
+"""
+
+import heapq
+import logging
+import random
+import signal
+import time
+import traceback
+
+from wrapid.utils import now
+
+from pubrefdb import configuration
+from pubrefdb import fetch
+from pubrefdb import patch
+from pubrefdb.database import MetadataSaver, XrefSet
+from pubrefdb.runlock import RunLock
+
+
+class Scheduler(object):
+    "Run the fetches for the PIs, and the patch sweeps, when due."
+
+    def __init__(self, db):
+        self.db = db
+        self.queue = []                 # Heap of (due, priority, name)
+        self.names = set()
+        self.active = set()
+        self.loaded = 0.0
+        self.patched = time.time()
+        self.stopped = False
+        self.last_run = None
+        self.known = None               # XrefSet, loaded at first fetch.
+
+    def stop(self, *args):
+        "Stop the scheduler after the current run."
+        self.stopped = True
+
+    def run(self):
+        "Loop until stopped, running the fetches and patches when due."
+        logging.info('scheduler started')
+        while not self.stopped:
+            if time.time() - self.loaded > configuration.SCHEDULER_RELOAD:
+                self.load()
+            names = self.get_due()
+            if names:
+                self.run_fetch(names)
+            elif time.time() - self.patched > configuration.PATCH_INTERVAL:
+                self.run_patch()
+            else:
+                if self.queue:
+                    wait = self.queue[0][0] - time.time()
+                else:
+                    wait = configuration.SCHEDULER_POLL
+                time.sleep(max(1.0, min(wait, configuration.SCHEDULER_POLL)))
+        logging.info('scheduler stopped')
+
+    def load(self):
+        """Synchronize the queue with the PI list. New PIs are scheduled
+        from the checkpoint of their last fetch, if any.
+        """
+        try:
+            fetched = self.db['fetched']
+        except Exception:
+            fetched = dict()
+        checkpoints = fetched.get('checkpoints', dict())
+        for record in fetched.get('pis', []):
+            if record.get('added'):
+                self.active.add(record['name'])
+        names = set([name for name, affiliations
+                     in fetch.get_pis_affiliations(self.db)])
+        self.queue = [item for item in self.queue if item[2] in names]
+        heapq.heapify(self.queue)
+        for name in names.difference(self.names):
+            try:
+                last = time.mktime(time.strptime(checkpoints[name], '%Y/%m/%d'))
+            except (KeyError, ValueError):
+                due = time.time()
+            else:
+                due = last + self.get_interval(name)
+            self.schedule(name, due)
+        self.names = names
+        self.loaded = time.time()
+        self.save_status()
+
+    def get_interval(self, name):
+        "Get the fetch interval for the PI, with random jitter."
+        if name in self.active:
+            interval = configuration.FETCH_INTERVAL_ACTIVE
+        else:
+            interval = configuration.FETCH_INTERVAL
+        jitter = configuration.FETCH_JITTER
+        return interval * (1.0 + random.uniform(-jitter, jitter))
+
+    def schedule(self, name, due):
+        "Add the PI to the queue; active PIs go first when due together."
+        priority = name not in self.active and 1 or 0
+        heapq.heappush(self.queue, (due, priority, name))
+
+    def get_due(self):
+        "Remove the PIs that are due from the queue, and return their names."
+        names = []
+        current = time.time()
+        while self.queue and self.queue[0][0] <= current and \
+              len(names) < configuration.FETCH_GROUP_SIZE:
+            names.append(heapq.heappop(self.queue)[2])
+        return names
+
+    def run_fetch(self, names):
+        "Fetch the publications for the PIs, and schedule their next fetch."
+        status = self.execute('fetch', self.fetch, pinames=names)
+        if status == 'error':           # Xrefs may have been added but not saved.
+            self.known = None
+        if status == 'locked':
+            for name in names:
+                self.schedule(name, time.time() + configuration.SCHEDULER_POLL)
+            self.save_status()
+            return
+        try:
+            records = dict([(r['name'], r) for r in self.db['fetched']['pis']])
+        except Exception:
+            records = dict()
+        for name in names:
+            if records.get(name, dict()).get('added'):
+                self.active.add(name)
+            else:
+                self.active.discard(name)
+            self.schedule(name, time.time() + self.get_interval(name))
+        self.save_status()
+
+    def fetch(self, pinames):
+        "Fetch for the PIs, skipping the PMIDs already known."
+        if self.known is None:
+            self.known = XrefSet(self.db)
+        fetch.fetch(self.db, pinames=pinames, known=self.known)
+
+    def run_patch(self):
+        "Patch the incomplete publications."
+        status = self.execute('patch', patch.patch, self.db, log=False)
+        if status == 'locked':
+            self.patched += configuration.SCHEDULER_POLL
+        else:
+            self.patched = time.time()
+        self.save_status()
+
+    def execute(self, kind, func, *args, **kwargs):
+        """Execute the run while holding the run lock, and record its status.
+        Return 'ok', 'error', or 'locked' if another run is in progress.
+        """
+        self.last_run = dict(kind=kind, started=now())
+        if kind == 'fetch':
+            self.last_run['pis'] = kwargs['pinames']
+        lock = RunLock(configuration.RUN_LOCK_FILE)
+        try:
+            lock.acquire()
+        except IOError, message:
+            self.last_run['status'] = 'locked'
+            self.last_run['error'] = str(message)
+        else:
+            try:
+                logging.info("scheduler %s started", kind)
+                func(*args, **kwargs)
+            except Exception:
+                self.last_run['status'] = 'error'
+                self.last_run['error'] = traceback.format_exc(limit=20)
+                logging.error("scheduler %s failed", kind)
+            else:
+                self.last_run['status'] = 'ok'
+                if kind == 'fetch':
+                    error = self.db['fetched'].get('error')
+                    if error:
+                        self.last_run['status'] = 'error'
+                        self.last_run['error'] = error
+            finally:
+                lock.release()
+        self.last_run['finished'] = now()
+        return self.last_run['status']
+
+    def save_status(self):
+        "Record the queue depth and the status of the last run."
+        try:
+            doc = self.db['scheduler']
+        except Exception:
+            doc = dict(_id='scheduler')
+        if self.queue:
+            due = time.localtime(min(self.queue)[0])
+            next_due = time.strftime(configuration.DATETIME_FORMAT, due)
+        else:
+            next_due = None
+        with MetadataSaver(self.db, doc):
+            doc['queue'] = len(self.queue)
+            doc['active'] = len(self.active)
+            doc['next'] = next_due
+            doc['last_run'] = self.last_run
+
+
+if __name__ == '__main__':
+    import sys
+    try:
+        lock = RunLock(configuration.SCHEDULER_LOCK_FILE)
+        lock.acquire()
+    except IOError, message:
+        sys.exit("scheduler already running: %s" % message)
+    scheduler = Scheduler(configuration.get_db())
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+    try:
+        scheduler.run()
+    finally:
+        lock.release()
@@ -6,33 +6,11 @@ Search for publications.
 import urllib
 
 from .base import *
+from . import textindex
+from . import workers
+from .cache import get_update_seq, searches
+from .textindex import RSTRIP, IGNORE
 
-# Must be kept in sync with title.js
-RSTRIP = '-\.:,?'
-IGNORE = {
-    'a': 1,
-    'an': 1,
-    'and': 1,
-    'are': 1,
-    'as': 1,
-    'at': 1,
-    'but': 1,
-    'by': 1,
-    'can': 1,
-    'for': 1,
-    'from': 1,
-    'into': 1,
-    'in': 1,
-    'is': 1,
-    'of': 1,
-    'on': 1,
-    'or': 1,
-    'that': 1,
-    'the': 1,
-    'to': 1,
-    'using': 1,
-    'with': 1
-    }
 
 class SearchHtmlRepresentation(FormHtmlMixin,
                                PublicationsListMixin,
@@ -71,30 +49,32 @@ class Search(MethodMixin, GET):
             if not self.terms: raise KeyError
             self.terms = self.terms.strip()
             if not self.terms: raise KeyError
-            self.terms = [t.strip() for t in self.terms.split(',')]
+            self.terms = [' '.join(t.split()) for t in self.terms.split(',')]
+            self.terms = [t for t in self.terms if t]
         except KeyError:
             self.terms = []
 
     def get_data_resource(self, request):
-        result = self.search_xrefs()
-        if not result:
-            result = self.search_authors()
-            title_result = self.search_title()
-            if result:
-                if title_result:        # Limit authors by title words
-                    result.intersection_update(title_result)
-            else:
-                result = title_result
-            journal_result = self.search_journal()
-            if result:
-                if journal_result:      # Limit authors by journal name
-                    result.intersection_update(journal_result)
-            else:
-                result = journal_result
+        # The text index lags behind the database; a result from it is
+        # tagged with the database identity and the sequence of the last
+        # change applied to it.
+        if textindex.index.is_ready():
+            mode = 'text'
+            update_seq = (textindex.index.identity, textindex.index.seq)
+        else:
+            mode = 'views'
+            update_seq = get_update_seq(self.db)
+        key = (mode, tuple(self.terms))
+        try:
+            result, ranked = searches.get(key, update_seq)
+        except KeyError:
+            result, ranked = self.search(mode)
+            searches.put(key, update_seq, result, ranked=ranked)
         if len(result) == 1:
             raise HTTP_SEE_OTHER(Location=request.application.get_url(result.pop()))
-        publications = [self.db[i] for i in result]
-        self.sort_publications(publications)
+        publications = documents.get_many(self.db, result)
+        if not ranked:
+            self.sort_publications(publications)
         for publication in publications:
             self.normalize_publication(publication, request.application.get_url)
         override = dict(terms=dict(default=', '.join(self.terms)))
@@ -116,61 +96,191 @@ class Search(MethodMixin, GET):
                 outrepr['href'] += '?' + terms
         return outreprs
 
+    def search(self, mode):
+        """Return the list of publication id's for the terms, and whether
+        it is ranked by relevance. Publications with a term as xref are
+        returned if any, else those found using the text index, if the
+        mode is 'text', else using the indexes of the database.
+        """
+        result = self.search_xrefs()
+        if result:
+            return list(result), False
+        elif mode == 'text':
+            return self.search_text(), True
+        else:
+            return list(self.search_planned()), False
+
     def search_xrefs(self):
-        "Return union of all publications id's for xdb:xref terms."
-        view = self.db.view('publication/xref')
-        result = set()
+        """Return union of all publications id's for xdb:xref terms,
+        using one request for all terms.
+        """
+        keys = []
         for term in self.terms:
             try:
                 xdb, xkey = term.split(':', 1)
             except ValueError:
                 xdb = 'pubmed'
                 xkey = term
-            items = view[[xdb.lower(), xkey]]
-            result.update(set([i.id for i in items]))
-        return result
-
-    def search_authors(self):
-        "Return intersection of all publication id's for author names."
-        view = self.db.view('publication/author')
-        result = set()
+            keys.append([xdb.lower(), xkey])
+        if not keys: return set()
+        return set([i.id for i in self.db.view('publication/xref', keys=keys)])
+
+    def search_text(self):
+        """Return the list of publication id's matching all terms, each
+        either as an author name prefix, or by its words in the title,
+        abstract or journal, by descending relevance.
+        """
+        return textindex.index.search(self.terms)
+
+    def get_lookups(self):
+        """Get the lookups of all terms in the author, title word
+        and journal indexes.
+        """
+        lookups = []
+        for term in self.terms:
+            author = to_ascii(term).lower()
+            lookups.append(Lookup('publication/author',
+                                  match_author(author),
+                                  startkey=author,
+                                  endkey=author+'Z'))
         for term in self.terms:
-            author = to_ascii(term)
-            items = view[author : author+'Z']
-            items = set([i.id for i in items])
-            if len(items) > 0:
-                if result:
-                    result.intersection_update(items)
-                else:
-                    result = items
-        return result
-
-    def search_title(self):
-        "Return intersection of all publication id's for title words."
-        view = self.db.view('publication/title')
-        result = set()
-        terms = [t.rstrip(RSTRIP) for t in self.terms]
-        terms = [t for t in terms if t not in IGNORE]
-        if not terms: return result
-        for term in terms:
-            items = view[term : term+'Z']
-            items = set([i.id for i in items])
-            if len(items) > 0:
-                if result:
-                    result.intersection_update(items)
-                else:
-                    result = items
-        return result
-
-    def search_journal(self):
-        view = self.db.view('publication/journal')
-        result = set()
+            word = term.rstrip(RSTRIP).lower()
+            if not word or word in IGNORE: continue
+            lookups.append(Lookup('publication/title',
+                                  match_title(word),
+                                  startkey=word,
+                                  endkey=word+'Z'))
         for term in self.terms:
-            items = view[term]
-            items = set([i.id for i in items])
-            if len(items) > 0:
-                if result:
-                    result.intersection_update(items)
-                else:
-                    result = items
-        return result
+            lookups.append(Lookup('publication/journal',
+                                  match_journal(term),
+                                  key=term))
+        return lookups
+
+    def search_planned(self):
+        """Return the intersection of the publication id's for all lookups
+        of the terms, ignoring lookups which match nothing.
+        Each lookup is first probed with a limit on the number of rows;
+        the probes are made concurrently, those for single keys in one
+        request. The lookups which are complete within the limit are
+        applied from the smallest to the largest. The others are applied
+        by filtering
+        the documents of the remaining candidates, if they are few enough,
+        else by fetching all their rows. Stop when nothing remains.
+        """
+        lookups = self.get_lookups()
+        limit = configuration.SEARCH_PROBE_LIMIT
+        keyed = [l for l in lookups if 'key' in l.options]
+        probes = [lambda l=l: l.probe(self.db, limit)
+                  for l in lookups if 'key' not in l.options]
+        if keyed:
+            probes.append(lambda: probe_keys(self.db, keyed, limit))
+        list(workers.imap(lambda probe: probe(), probes,
+                          workers=configuration.SEARCH_THREADS))
+        lookups = [l for l in lookups if l.ids]
+        complete = [l for l in lookups if l.complete]
+        complete.sort(key=lambda l: len(l.ids))
+        result = None
+        for lookup in complete:
+            if result is None:
+                result = set(lookup.ids)
+            else:
+                result.intersection_update(lookup.ids)
+            if not result: return set()
+        for lookup in [l for l in lookups if not l.complete]:
+            if result is not None and \
+               len(result) <= configuration.SEARCH_FILTER_LIMIT:
+                result = set([doc['_id']
+                              for doc in documents.get_many(self.db, result)
+                              if lookup.match(doc)])
+            elif result is None:
+                result = lookup.fetch(self.db)
+            else:
+                result.intersection_update(lookup.fetch(self.db))
+            if not result: return set()
+        return result or set()
+
+
+class Lookup(object):
+    """Lookup of a search term in an index; either a key or a range of keys.
+    The predicate 'match' tells whether a document would be found by it.
+    """
+
+    def __init__(self, indexname, match, **options):
+        self.indexname = indexname
+        self.match = match
+        self.options = options
+        self.ids = set()
+        self.complete = False
+
+    def probe(self, db, limit):
+        """Get the ids of the documents found in at most 'limit' rows.
+        The lookup is complete if there were no more rows.
+        """
+        rows = list(db.view(self.indexname, limit=limit+1, **self.options))
+        self.complete = len(rows) <= limit
+        self.ids = set([row.id for row in rows[:limit]])
+
+    def fetch(self, db):
+        "Get the ids of all documents found."
+        if not self.complete:
+            rows = db.view(self.indexname, **self.options)
+            self.ids = set([row.id for row in rows])
+            self.complete = True
+        return self.ids
+
+
+def probe_keys(db, lookups, limit):
+    """Probe the lookups of single keys in the same index using one request.
+    If the rows exceed the limit for all lookups together, then probe
+    each separately.
+    """
+    keys = [l.options['key'] for l in lookups]
+    rows = list(db.view(lookups[0].indexname,
+                        keys=keys,
+                        limit=limit*len(keys)+1))
+    if len(rows) > limit*len(keys):
+        for lookup in lookups:
+            lookup.probe(db, limit)
+    else:
+        ids = dict()
+        for row in rows:
+            ids.setdefault(row.key, set()).add(row.id)
+        for lookup in lookups:
+            lookup.ids = ids.get(lookup.options['key'], set())
+            lookup.complete = True
+
+def match_author(name):
+    "Get the predicate for the author index key prefix, as in author.js"
+    def match(doc):
+        for author in doc.get('authors') or []:
+            lastname = author.get('lastname_normalized')
+            if not lastname: continue
+            keys = [lastname]
+            for key in ['initials_normalized', 'forename_normalized']:
+                if author.get(key):
+                    keys.append("%s %s" % (lastname, author[key]))
+            for key in keys:
+                if key.lower().startswith(name):
+                    return True
+        return False
+    return match
+
+def match_title(word):
+    "Get the predicate for the title word index key prefix, as in title.js"
+    def match(doc):
+        for part in (doc.get('title') or '').split():
+            part = part.lower()
+            if part and part[-1] in RSTRIP:
+                part = part[:-1]
+            if part.startswith(word) and part not in IGNORE:
+                return True
+        return False
+    return match
+
+def match_journal(name):
+    "Get the predicate for the journal index key, as in journal.js"
+    def match(doc):
+        journal = doc.get('journal')
+        if not journal: return False
+        return (journal.get('abbreviation') or journal.get('title')) == name
+    return match
@@ -0,0 +1,41 @@
+""" PubRefDb: Publication database web application.
+
+Statistics for the in-process caches of this worker process.
+"""
+
+from .base import *
+from .cache import documents, searches
+
+
+class StatsHtmlRepresentation(HtmlRepresentation):
+    "Display the statistics for each cache."
+
+    def get_content(self):
+        result = DIV()
+        for name, stats in sorted(self.data['caches'].items()):
+            table = TABLE(TR(TH(name.capitalize(), colspan=2)),
+                          klass='data')
+            for key, value in sorted(stats.items()):
+                if isinstance(value, float):
+                    value = "%.3f" % value
+                table.append(TR(TD(key),
+                                TD(str(value), klass='integer')))
+            result.append(table)
+        return result
+
+
+class Stats(MethodMixin, GET):
+    """Statistics for the caches of the worker process serving this request.
+    Each process has its own caches."""
+
+    outreprs = [JsonRepresentation,
+                StatsHtmlRepresentation]
+
+    def is_accessible(self):
+        return self.is_login_admin()
+
+    def get_data_resource(self, request):
+        return dict(title='Cache statistics',
+                    caches=dict(documents=documents.get_stats(),
+                                searches=searches.get_stats()),
+                    descr=self.__doc__)
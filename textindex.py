@@ -0,0 +1,552 @@
+""" PubRefDb: Publication database web application.
+
+In-process inverted index for ranked full-text search of publications.
+
+The title, abstract and journal of each publication are tokenized into
+words, and the keys of its authors are indexed as terms of their own, as
+in the author index: 'lastname', 'lastname initials' and 'lastname
+forename'. The term frequencies are recorded in posting lists compressed
+as variable-length integers: the difference to the previous document
+number, and the weighted term frequency. Posting lists are append-only;
+a publication that is modified gets a new document number, and the old
+one is marked deleted. The index is compacted when many are deleted.
+Results are ranked by BM25.
+
+Each comma-separated term of a query matches a publication if it is
+the prefix of an author key, or if all its words, each as a prefix,
+are found in the text. The terms and words are processed from the least
+to the most frequent, stopping when no publication matches all terms.
+Each posting list
+has skip entries for every block of postings, so that the postings of
+a frequent word are looked up only for the remaining candidates,
+instead of being decoded in full.
+
+The index is built in a background thread, or loaded from a snapshot
+file, and then kept current by following the changes feed of the
+database. Snapshots are saved with the update sequence they correspond
+to, so that a restart only needs to catch up on the later changes.
+A snapshot also records the identity of the database: its name and
+a random id kept in a local document, which is neither replicated nor
+dumped. A snapshot for another database, or for one restored from
+a dump, is not used, and the index is rebuilt when the identity of the
+database changes while it is followed.
+"""
+
+import array
+import bisect
+import cPickle as pickle
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+import couchdb
+
+from wrapid.utils import to_ascii
+
+from . import configuration
+from .bulk import iterate_view
+
+
+# Must be kept in sync with title.js
+RSTRIP = '-\.:,?'
+IGNORE = {
+    'a': 1,
+    'an': 1,
+    'and': 1,
+    'are': 1,
+    'as': 1,
+    'at': 1,
+    'but': 1,
+    'by': 1,
+    'can': 1,
+    'for': 1,
+    'from': 1,
+    'into': 1,
+    'in': 1,
+    'is': 1,
+    'of': 1,
+    'on': 1,
+    'or': 1,
+    'that': 1,
+    'the': 1,
+    'to': 1,
+    'using': 1,
+    'with': 1
+    }
+STRIP = '()[]{}"\';'
+
+FIELD_WEIGHTS = dict(title=3, authors=2, journal=2, abstract=1)
+
+K1 = 1.2
+B = 0.75
+
+AUTHOR = ' author:'                     # Prefix of author key terms; the
+                                        # tokenizer never produces a space.
+SKIP = 64                               # Postings per skip block
+
+SNAPSHOT_VERSION = 4
+IDENTITY_DOC = '_local/pubrefdb_identity'
+
+
+def tokenize(text):
+    """Split the text into lower-case ASCII words, stripped of brackets,
+    quotes and trailing punctuation, skipping common short words.
+    """
+    result = []
+    for word in to_ascii(text or '').lower().split():
+        word = word.strip(STRIP).rstrip(RSTRIP)
+        if word and word not in IGNORE:
+            result.append(word)
+    return result
+
+def get_fields(doc):
+    "Get the texts of the word-indexed fields of the publication, by field."
+    journal = doc.get('journal') or dict()
+    return dict(title=doc.get('title'),
+                abstract=doc.get('abstract'),
+                journal="%s %s" % (journal.get('title') or '',
+                                   journal.get('abbreviation') or ''))
+
+def get_author_keys(doc):
+    "Get the set of author keys of the publication, as in author.js"
+    result = set()
+    for author in doc.get('authors') or []:
+        lastname = author.get('lastname_normalized')
+        if not lastname: continue
+        result.add(to_ascii(lastname).lower())
+        for key in ['initials_normalized', 'forename_normalized']:
+            if author.get(key):
+                result.add(to_ascii("%s %s" % (lastname, author[key])).lower())
+    return result
+
+def get_identity(db):
+    """Get the identity of the database; its name and the random id
+    in the local identity document, which is created if missing.
+    """
+    try:
+        return (db.name, db[IDENTITY_DOC]['uuid'])
+    except couchdb.http.ResourceNotFound:
+        try:
+            db.save(dict(_id=IDENTITY_DOC, uuid=uuid.uuid4().hex))
+        except couchdb.http.ResourceConflict: # Created by another process.
+            pass
+        return (db.name, db[IDENTITY_DOC]['uuid'])
+
+def encode_varint(value, data):
+    "Append the non-negative integer to the bytearray."
+    while value >= 0x80:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+
+def decode_postings(data, number=0):
+    """Iterate over the (document number, frequency) in the posting list,
+    or the block of it, starting from the given document number.
+    """
+    value = shift = 0
+    first = True
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        if first:
+            number += value
+        else:
+            yield number, value
+        first = not first
+        value = shift = 0
+
+
+class TextIndex(object):
+    "Inverted index of publications, with BM25-ranked search."
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.ready = False
+        self.reset()
+
+    def reset(self):
+        "Make the index empty."
+        self.identity = None
+        self.seq = None
+        self.ids = []                   # Document id by number; None if dead
+        self.numbers = dict()           # Document number by id
+        self.lengths = array.array('L') # Weighted length by number
+        self.total = 0                  # Weighted length of all live docs
+        self.dead = 0
+        self.postings = dict()          # Posting list bytearray by term
+        self.last = dict()              # Last document number by term
+        self.df = dict()                # Posting list length by term
+        self.skips = dict()             # (numbers, offsets) of blocks by term
+        self.terms = None               # Sorted terms, for prefix search
+        self.changed = False
+
+    def start(self):
+        "Start the background thread building and updating the index."
+        if self.thread is not None: return
+        with self.lock:
+            if self.thread is not None: return
+            self.thread = threading.Thread(target=self.run)
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def is_ready(self):
+        "Is the index built? If not, start building it."
+        self.start()
+        return self.ready
+
+    def run(self):
+        """Load or build the index, and then follow the changes feed.
+        On failure, retry from the last change seen, unless the database
+        is another one, in which case the index is loaded or built anew.
+        """
+        delay = 1.0
+        saved = time.time()
+        while True:
+            try:
+                db = configuration.get_db()
+                identity = get_identity(db)
+                if self.seq is None or self.identity != identity:
+                    self.ready = False
+                    if not self.load(identity):
+                        self.build(db, identity)
+                    self.ready = True
+                changes = db.changes(feed='continuous',
+                                     since=self.seq,
+                                     include_docs=True,
+                                     heartbeat=configuration.CHANGES_HEARTBEAT)
+                for change in changes:
+                    if 'last_seq' in change:
+                        self.seq = change['last_seq']
+                        break
+                    with self.lock:
+                        if change.get('deleted'):
+                            self.remove(change['id'])
+                        else:
+                            self.add(change['doc'])
+                        self.seq = change['seq']
+                    if time.time() - saved > \
+                       configuration.TEXTINDEX_SNAPSHOT_INTERVAL:
+                        self.save()
+                        saved = time.time()
+                    delay = 1.0
+            except Exception, message:
+                logging.warning("text index update failed: %s", message)
+                time.sleep(delay)
+                delay = min(2 * delay, 60.0)
+
+    def build(self, db, identity):
+        "Index all publications in the database with the given identity."
+        logging.info('text index build started')
+        seq = db.info()['update_seq']
+        with self.lock:
+            self.reset()
+            self.identity = identity
+        for row in iterate_view(db, 'publication/modified', include_docs=True):
+            with self.lock:
+                self.add(row.doc)
+        with self.lock:
+            self.seq = seq
+        logging.info("text index built: %s publications", len(self.numbers))
+        self.save()
+
+    def add(self, doc):
+        """Add the publication, replacing any previous version.
+        Documents other than publications are removed, if indexed.
+        The lock must be held.
+        """
+        self.remove(doc['_id'])
+        if doc.get('entitytype') != 'publication': return
+        frequencies = dict()
+        for field, text in get_fields(doc).items():
+            weight = FIELD_WEIGHTS[field]
+            for term in tokenize(text):
+                frequencies[term] = frequencies.get(term, 0) + weight
+        for key in get_author_keys(doc):
+            frequencies[AUTHOR + key] = FIELD_WEIGHTS['authors']
+        number = len(self.ids)
+        self.ids.append(doc['_id'])
+        self.numbers[doc['_id']] = number
+        length = sum(frequencies.values())
+        self.lengths.append(length)
+        self.total += length
+        for term, frequency in frequencies.iteritems():
+            try:
+                data = self.postings[term]
+            except KeyError:
+                data = self.postings[term] = bytearray()
+                self.skips[term] = (array.array('L'), array.array('L'))
+                self.terms = None
+            last = self.last.get(term, 0)
+            df = self.df.get(term, 0)
+            if df % SKIP == 0:
+                self.skips[term][0].append(last)
+                self.skips[term][1].append(len(data))
+            encode_varint(number - last, data)
+            encode_varint(frequency, data)
+            self.last[term] = number
+            self.df[term] = df + 1
+        self.changed = True
+
+    def remove(self, id):
+        "Mark the publication as deleted, if indexed. The lock must be held."
+        number = self.numbers.pop(id, None)
+        if number is None: return
+        self.ids[number] = None
+        self.total -= self.lengths[number]
+        self.dead += 1
+        self.changed = True
+        if self.dead > 100 and 4 * self.dead > len(self.ids):
+            self.compact()
+
+    def compact(self):
+        """Rebuild the posting lists without the deleted documents,
+        renumbering the live ones. The lock must be held.
+        """
+        renumber = dict()
+        ids = []
+        lengths = array.array('L')
+        for number, id in enumerate(self.ids):
+            if id is None: continue
+            renumber[number] = len(ids)
+            ids.append(id)
+            lengths.append(self.lengths[number])
+        postings = dict()
+        last = dict()
+        df = dict()
+        skips = dict()
+        for term, data in self.postings.iteritems():
+            new = bytearray()
+            previous = 0
+            count = 0
+            numbers, offsets = array.array('L'), array.array('L')
+            for number, frequency in decode_postings(data):
+                try:
+                    number = renumber[number]
+                except KeyError:
+                    continue
+                if count % SKIP == 0:
+                    numbers.append(previous)
+                    offsets.append(len(new))
+                encode_varint(number - previous, new)
+                encode_varint(frequency, new)
+                previous = number
+                count += 1
+            if count:
+                postings[term] = new
+                last[term] = previous
+                df[term] = count
+                skips[term] = (numbers, offsets)
+        self.ids = ids
+        self.numbers = dict([(id, n) for n, id in enumerate(ids)])
+        self.lengths = lengths
+        self.postings = postings
+        self.last = last
+        self.df = df
+        self.skips = skips
+        self.dead = 0
+        self.terms = None
+
+    def expand(self, term):
+        """Get the indexed terms having the query term as prefix,
+        including the term itself. The lock must be held.
+        """
+        if self.terms is None:
+            self.terms = sorted(self.postings)
+        result = []
+        for position in xrange(bisect.bisect_left(self.terms, term),
+                               len(self.terms)):
+            candidate = self.terms[position]
+            if not candidate.startswith(term): break
+            result.append(candidate)
+        return result
+
+    def seek(self, term, numbers):
+        """Iterate over the (document number, frequency) in the posting list
+        of the term for the given document numbers, in increasing order,
+        decoding only the blocks which may contain them.
+        The lock must be held.
+        """
+        data = self.postings[term]
+        starts, offsets = self.skips[term]
+        for number in numbers:
+            block = max(bisect.bisect_left(starts, number) - 1, 0)
+            if block + 1 < len(offsets):
+                end = offsets[block + 1]
+            else:
+                end = len(data)
+            for found, frequency in decode_postings(data[offsets[block]:end],
+                                                    starts[block]):
+                if found >= number:
+                    if found == number:
+                        yield found, frequency
+                    break
+
+    def search(self, terms):
+        """Get the ids of the publications matching all the terms,
+        as a list sorted by descending BM25 score. A term matches
+        a publication if it is the prefix of an author key, or if each
+        of its words is the prefix of a word in the text. Terms not
+        matching any publication are ignored.
+        """
+        with self.lock:
+            count = len(self.numbers)
+            if not count: return []
+            clauses = []
+            for term in terms:
+                key = ' '.join(to_ascii(term).lower().split())
+                authors = key and self.expand(AUTHOR + key) or []
+                words = [self.expand(word) for word in set(tokenize(term))]
+                if not all(words):      # Some word not in any publication.
+                    words = []
+                if authors or words:
+                    clauses.append((authors, words))
+            clauses.sort(key=self.get_estimate)
+            scores = None
+            for authors, words in clauses:
+                current = self.score_terms(authors, scores)
+                for number, score in self.score_words(words, scores).items():
+                    current[number] = max(current.get(number, 0.0), score)
+                scores = self.combine(scores, current)
+                if not scores: break
+            if not scores: return []
+            result = sorted(scores.items(), key=lambda i: (-i[1], i[0]))
+            return [self.ids[number] for number, score in result]
+
+    def get_estimate(self, clause):
+        "Get an upper bound of the number of matches for the query term."
+        authors, words = clause
+        result = sum([self.df[t] for t in authors])
+        if words:
+            result += min([sum([self.df[t] for t in w]) for w in words])
+        return result
+
+    def combine(self, scores, current):
+        """Get the sum of the scores of the documents in both,
+        or the current scores if no previous. The lock must be held.
+        """
+        if scores is None: return current
+        return dict([(number, score + current[number])
+                     for number, score in scores.iteritems()
+                     if number in current])
+
+    def score_words(self, words, candidates):
+        """Get the scores of the candidate documents, or all documents
+        if None, matching all the words; each a list of the terms matching
+        it. The words are processed from the least to the most frequent.
+        The lock must be held.
+        """
+        words = sorted(words, key=lambda terms: sum([self.df[t] for t in terms]))
+        scores = None
+        for terms in words:
+            scores = self.combine(scores,
+                                  self.score_terms(terms, scores or candidates))
+            if not scores: break
+        return scores or dict()
+
+    def score_terms(self, terms, candidates):
+        """Get the scores of the candidate documents, or all documents
+        if None, matching any of the terms; the best score if several.
+        The posting list of a term is looked up only for the candidates,
+        if fewer than the blocks to decode. The lock must be held.
+        """
+        count = len(self.numbers)
+        average = float(self.total) / count
+        if candidates is not None:
+            numbers = sorted(candidates)
+        result = dict()
+        for term in terms:
+            df = min(self.df[term], count)
+            idf = math.log(1.0 + (count - df + 0.5) / (df + 0.5))
+            if candidates is not None and \
+               len(numbers) < len(self.skips[term][0]):
+                postings = self.seek(term, numbers)
+            else:
+                postings = decode_postings(self.postings[term])
+            for number, frequency in postings:
+                if self.ids[number] is None: continue
+                if candidates is not None and number not in candidates:
+                    continue
+                norm = K1 * (1.0 - B + B * self.lengths[number] / average)
+                score = idf * frequency * (K1 + 1.0) / (frequency + norm)
+                result[number] = max(result.get(number, 0.0), score)
+        return result
+
+    def save(self):
+        """Save a snapshot of the index to the file, if changed.
+        The file is replaced atomically.
+        """
+        filepath = configuration.TEXTINDEX_FILE
+        if not filepath or not self.changed: return
+        with self.lock:
+            data = dict(version=SNAPSHOT_VERSION,
+                        identity=self.identity,
+                        seq=self.seq,
+                        ids=list(self.ids),
+                        lengths=self.lengths.tostring(),
+                        total=self.total,
+                        dead=self.dead,
+                        postings=dict([(t, str(d)) for t, d
+                                       in self.postings.iteritems()]),
+                        last=dict(self.last),
+                        df=dict(self.df),
+                        skips=dict([(t, (n.tostring(), o.tostring()))
+                                    for t, (n, o)
+                                    in self.skips.iteritems()]))
+            self.changed = False
+        try:
+            fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(filepath),
+                                           prefix=os.path.basename(filepath))
+            try:
+                with os.fdopen(fd, 'wb') as outfile:
+                    pickle.dump(data, outfile, pickle.HIGHEST_PROTOCOL)
+                os.rename(tmppath, filepath)
+            except:
+                os.remove(tmppath)
+                raise
+        except (IOError, OSError), message:
+            logging.warning("could not save text index: %s", message)
+
+    def load(self, identity):
+        """Load the snapshot of the index from the file, if any,
+        and if for the database with the given identity.
+        """
+        filepath = configuration.TEXTINDEX_FILE
+        if not filepath: return False
+        try:
+            with open(filepath, 'rb') as infile:
+                data = pickle.load(infile)
+            if data.get('version') != SNAPSHOT_VERSION: return False
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return False
+        if data.get('identity') != identity:
+            logging.info('text index snapshot is for another database')
+            return False
+        with self.lock:
+            self.reset()
+            self.identity = identity
+            self.seq = data['seq']
+            self.ids = data['ids']
+            self.numbers = dict([(id, n) for n, id in enumerate(self.ids)
+                                 if id is not None])
+            self.lengths.fromstring(data['lengths'])
+            self.total = data['total']
+            self.dead = data['dead']
+            self.postings = dict([(t, bytearray(d)) for t, d
+                                  in data['postings'].iteritems()])
+            self.last = data['last']
+            self.df = data['df']
+            for term, (numbers, offsets) in data['skips'].iteritems():
+                self.skips[term] = (array.array('L', []), array.array('L', []))
+                self.skips[term][0].fromstring(numbers)
+                self.skips[term][1].fromstring(offsets)
+        logging.info("text index loaded: %s publications", len(self.numbers))
+        return True
+
+index = TextIndex()
@@ -1,33 +1,119 @@
 """ PubRefDb: Web application for a database of publications.
 
 Load all documents from a dump into the database.
+
+The dump file is read as a stream, and the documents are written
+in chunks by several parallel workers. The current revisions of
+existing documents are looked up for each chunk in one request.
+
+A full dump may be followed by a chain of incremental dumps,
+each of which must start at the update sequence of the previous.
 """
 
 import json
-
-import couchdb
+import sys
 
 from pubrefdb import configuration
+from pubrefdb import workers
+from pubrefdb.bulk import get_revisions
+from pubrefdb.database import BulkSaver
+from pubrefdb.dump import HEADER, open_file
 
 
-def undump(db, infile):
-    data = json.load(infile)
-    for id, doc in data.iteritems():
-        try:
-            del doc['_rev']
-        except KeyError:
-            pass
+def read_dump(infile):
+    """Return the header (None if old format) of the dump file,
+    and an iterator over its documents.
+    """
+    for line in infile:
+        if line.strip(): break
+    else:
+        return None, iter([])
+    data = json.loads(line)
+    if data.has_key(HEADER):
+        return data[HEADER], read_docs(infile)
+    else:
+        return None, read_docs(infile, first=data)
+
+def read_docs(infile, first=None):
+    """Iterate over the documents in the dump file.
+    Handles both JSON Lines and the older single JSON object format;
+    the latter is necessarily read into memory all at once.
+    """
+    if first is not None:
+        if first.has_key('_id'):
+            yield first
+        else:                           # Old format: all docs in one line
+            for doc in first.itervalues():
+                yield doc
+    for line in infile:
+        if not line.strip(): continue
+        yield json.loads(line)
+
+def undump_files(db, filepaths, chunk_size=None, threads=4, log=True):
+    """Load the dump files in order; a full dump followed by incremental
+    dumps. Raise ValueError if the sequence of dumps is not unbroken.
+    Return the list of (id, exception) for documents not saved.
+    """
+    conflicts = []
+    previous = None
+    for filepath in filepaths:
+        infile = open_file(filepath)
         try:
-            olddoc = db[id]
-        except couchdb.http.ResourceNotFound:
-            pass
-        else:
-            doc['_rev'] = olddoc['_rev']
-        db.save(doc)
-        print id, doc['entitytype']
+            header, docs = read_dump(infile)
+            if previous is not None:
+                if header is None or header['since'] != previous['update_seq']:
+                    raise ValueError("%s does not follow the previous dump"
+                                     % filepath)
+            if log:
+                print >>sys.stderr, 'Loading', filepath
+            conflicts.extend(undump(db, docs,
+                                    chunk_size=chunk_size,
+                                    threads=threads,
+                                    log=log))
+        finally:
+            infile.close()
+        previous = header
+    return conflicts
+
+def undump(db, docs, chunk_size=None, threads=4, log=True):
+    """Load the documents from the dump into the database.
+    Return the list of (id, exception) for documents not saved.
+    """
+    chunk_size = chunk_size or configuration.BULK_CHUNK_SIZE
+    count = 0
+    conflicts = []
+    results = workers.imap(lambda docs: restore(db, docs),
+                           workers.chunks(docs, chunk_size),
+                           workers=threads)
+    for saved, errors in results:
+        count += saved
+        conflicts.extend(errors)
+        if log:
+            print >>sys.stderr, count, 'documents'
+    if log:
+        for id, exc in conflicts:
+            print 'Error', id, exc
+    return conflicts
+
+def restore(db, docs):
+    """Save the documents in one '_bulk_docs' request, overwriting
+    the current revision of those already existing. Deletion stubs
+    are applied to existing documents, and otherwise skipped.
+    Return the number saved and the list of (id, exception) not saved.
+    """
+    revisions = get_revisions(db, [doc['_id'] for doc in docs])
+    saver = BulkSaver(db, chunk_size=len(docs))
+    with saver:
+        for doc in docs:
+            try:
+                doc['_rev'] = revisions[doc['_id']]
+            except KeyError:
+                if doc.get('_deleted'): continue
+                doc.pop('_rev', None)
+            saver.add(doc)
+    return saver.saved, saver.conflicts
 
 
 if __name__ == '__main__':
-    infile = open('dump.json')
-    undump(configuration.get_db(), infile)
-    infile.close()
+    filepaths = sys.argv[1:] or ['dump.json']
+    undump_files(configuration.get_db(), filepaths)
@@ -0,0 +1,78 @@
+""" PubRefDb: Publication database web application.
+
+Run a function over items using a number of worker threads.
+"""
+
+import collections
+import Queue
+import sys
+import threading
+
+
+class Task(object):
+    "Application of a function to an item, to be run in a worker thread."
+
+    def __init__(self, func, item):
+        self.func = func
+        self.item = item
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(self.item)
+        except:
+            self.error = sys.exc_info()
+        self.done.set()
+
+    def get(self):
+        "Wait for the result; re-raise any exception from the function."
+        self.done.wait()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+
+def imap(func, items, workers=4):
+    """Apply the function to each item using the given number of threads.
+    Yield the results in the order of the items. The items are consumed
+    lazily; at most twice the number of workers are in progress at any time.
+    An exception raised by the function is re-raised here.
+    """
+    tasks = Queue.Queue()
+    def work():
+        while True:
+            task = tasks.get()
+            if task is None: return
+            task.run()
+    threads = [threading.Thread(target=work) for i in xrange(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    pending = collections.deque()
+    try:
+        for item in items:
+            task = Task(func, item)
+            pending.append(task)
+            tasks.put(task)
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        for thread in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+
+def chunks(items, size):
+    "Iterate over lists of at most the given size from the items."
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -21,6 +21,8 @@ from pubrefdb.journal import *
 from pubrefdb.tag import *
 from pubrefdb.pilist import *
 from pubrefdb.search import *
+from pubrefdb.duplicates import *
+from pubrefdb.stats import *
 from pubrefdb.about import *
 from pubrefdb.documentation import *
 
@@ -125,6 +127,12 @@ application.add_resource('/pubmed/{pmid}',
 application.add_resource('/search',
                          name='Publication search',
                          GET=Search)
+application.add_resource('/duplicates',
+                         name='Publication duplicates',
+                         GET=Duplicates)
+application.add_resource('/stats',
+                         name='Cache statistics',
+                         GET=Stats)
 
 # Edit PI list
 application.add_resource('/pilist',